@@ -1,22 +1,22 @@
 import streamlit as st
 import pandas as pd
-import requests
-from bs4 import BeautifulSoup
-from docxtpl import DocxTemplate
-import pikepdf
-import os
-import re
-import zipfile
-import tempfile
+import io
+import hashlib
+import json
 import sys
 import platform
 import time
-from io import StringIO
 
-# --- Windows COM 設定 ---
-if os.name == 'nt':
-    import pythoncom
-    import win32com.client
+from pdf_convert import BACKENDS
+from attendance import NAME_MATCH_THRESHOLD
+from event_info import fetch_event_info, fetch_events, parse_event_list
+from registration import REQUIRED_COLUMNS
+from pipeline import match_registration, registration_only
+from run_report import RunReport
+from cert_cache import default_cache_dir
+from job_queue import ACTIVE_STATES, JobQueue
+import registration
+import pipeline
 
 # --- 設定頁面 ---
 st.set_page_config(page_title="CPD Cert Generator", layout="wide")
@@ -34,20 +34,16 @@ if 'event_details' not in st.session_state:
 
 if st.button("抓取活動資訊"):
     try:
-        response = requests.get(url)
-        response.encoding = 'utf-8' 
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        title_tag = soup.find(id="ctl00_ContentPlaceHolder1_ContentName")
-        if title_tag:
-            st.session_state['event_title'] = title_tag.get_text(strip=True)
+        started = time.perf_counter()
+        info = fetch_event_info(url)
+        st.session_state['fetch_seconds'] = time.perf_counter() - started
+        if info['title'] is not None:
+            st.session_state['event_title'] = info['title']
         else:
             st.warning("找不到標題，請手動輸入。")
 
-        dtv_tag = soup.find(id="ctl00_ContentPlaceHolder1_dtv")
-        if dtv_tag:
-            raw_dtv = dtv_tag.get_text(strip=True).replace(';', ' ')
-            st.session_state['event_details'] = raw_dtv
+        if info['details'] is not None:
+            st.session_state['event_details'] = info['details']
         else:
             st.warning("找不到日期時間，請手動輸入。")
             
@@ -55,6 +51,30 @@ if st.button("抓取活動資訊"):
     except Exception as e:
         st.error(f"抓取失敗: {e}")
 
+# 一次抓取多個活動 (例如整季)，並行下載；結果可下載為 cli.py --manifest 的起點
+with st.expander("批量抓取多個活動"):
+    event_list = st.text_area("活動 EventID 或網址 (每行一個，或以逗號分隔)", "")
+    if st.button("批量抓取"):
+        started = time.perf_counter()
+        st.session_state['bulk_events'] = fetch_events(parse_event_list(event_list))
+        st.session_state['fetch_seconds'] = time.perf_counter() - started
+    bulk_events = st.session_state.get('bulk_events')
+    use_bulk_events = False
+    if bulk_events:
+        failed = [e for e in bulk_events if e['error']]
+        if failed:
+            st.warning(f"{len(failed)} 個活動抓取失敗")
+        st.dataframe(pd.DataFrame(bulk_events))
+        manifest = [{'url': e['url'], 'title': e['title'], 'details': e['details']} for e in bulk_events if not e['error']]
+        # 批量模式：同一份名單 (只解析及核對一次) 為每個活動各生成一套證書
+        use_bulk_events = st.checkbox("以同一份名單為以上活動一次生成證書 (每個活動一個資料夾)", value=False)
+        st.download_button(
+            "📥 下載活動清單 (JSON)",
+            data=json.dumps(manifest, ensure_ascii=False, indent=2),
+            file_name="events.json",
+            mime="application/json",
+        )
+
 col1, col2 = st.columns(2)
 with col1:
     event_title = st.text_input("活動標題", value=st.session_state['event_title'])
@@ -65,252 +85,145 @@ with col2:
 st.header("2. 上傳資料檔")
 
 reg_file = st.file_uploader("上傳報名表 (Registration Excel) [必填]", type=['csv', 'xlsx'])
-template_file = st.file_uploader("上傳證書範本 (Word .docx) [必填]", type=['docx'])
+# 可上傳多個範本 (例如 CPD_Template.docx 及 CPD_Template - ITD_END.docx)，同一份名單一次生成
+template_files = st.file_uploader("上傳證書範本 (Word .docx，可多選) [必填]", type=['docx'], accept_multiple_files=True)
 
 use_zoom = st.checkbox("需要核對 Zoom 出席紀錄？", value=True)
 zoom_file = None
+match_names = False
+name_threshold = NAME_MATCH_THRESHOLD
 if use_zoom:
     zoom_file = st.file_uploader("上傳 Zoom 報告 (Attendee Excel) [選填]", type=['csv', 'xlsx'])
+    # Email 不同 (例如用私人 Email 登入 Zoom) 時，改以姓名相似度補配對
+    match_names = st.checkbox("Email 不符時以姓名補配對", value=True)
+    if match_names:
+        name_threshold = st.slider("姓名相似度門檻", 0.5, 1.0, NAME_MATCH_THRESHOLD, 0.05)
+
+# --- 快取 ---
+# 每次操作元件 Streamlit 都會重跑整個 app.py；以檔案內容的雜湊值 (及配對選項)
+# 作為快取鍵，報名表 / Zoom 報告只會解析一次，按「開始生成」時直接沿用已核對的名單
+CACHE_ENTRIES = 8
+
+
+def file_digest(uploaded):
+    return hashlib.sha256(uploaded.getvalue()).hexdigest()
+
+
+def _named_buffer(data, filename):
+    buf = io.BytesIO(data)
+    buf.name = filename
+    return buf
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def load_registration(reg_digest, _data, filename):
+    """讀取報名表並套用欄位對應。回傳 (df_reg, 是否找不到 Membership No 欄位)。"""
+    return registration.load_registration(_named_buffer(_data, filename))
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def load_zoom(zoom_digest, _data, filename):
+    """解析 Zoom 報告、合計重複登入的出席時間並加上正規化欄位。"""
+    return pipeline.load_zoom(_named_buffer(_data, filename))
+
+
+@st.cache_data(max_entries=4 * CACHE_ENTRIES, show_spinner=False)
+def match_lists(reg_digest, zoom_digest, match_names, name_threshold, _df_reg, _zoom):
+    """核對報名表與 Zoom 名單，回傳 (df_final, df_unmatched)。"""
+    # 以整欄運算 (hash join) 核對，取代逐行 iterrows
+    return match_registration(_df_reg, _zoom, match_names, name_threshold)
+
+
+@st.cache_resource
+def job_queue():
+    """背景生成佇列 (所有使用者共用)：最多同時執行 MAX_RUNNING 個工作，使用 Word 的工作逐一執行。"""
+    return JobQueue()
 
-# --- 輔助函式 ---
-def normalize_name(name):
-    if pd.isna(name): return ""
-    name = str(name).lower()
-    name = re.sub(r'\b(ir|mr|ms|miss|dr|prof)\b\.?', '', name)
-    name = re.sub(r'[^a-z\s]', '', name)
-    return " ".join(name.split())
-
-def parse_zoom_report(file_obj):
-    """Parse Zoom attendee report (CSV or Excel).
-    Handles multi-section format, trailing commas, and multiple join/leave entries.
-    Returns (DataFrame, error_msg). error_msg is None on success."""
-    is_csv = hasattr(file_obj, 'name') and file_obj.name.endswith('.csv')
-
-    if hasattr(file_obj, 'seek'):
-        file_obj.seek(0)
-
-    if is_csv:
-        # Read raw content for manual section detection
-        if hasattr(file_obj, 'read'):
-            content = file_obj.read()
-            if isinstance(content, bytes):
-                content = content.decode('utf-8-sig', errors='ignore')
-        else:
-            with open(file_obj, 'r', encoding='utf-8-sig', errors='ignore') as f:
-                content = f.read()
-
-        lines = content.split('\n')
-
-        # Locate the "Attendee Details" section header row
-        header_idx = -1
-        for i, line in enumerate(lines):
-            if 'Attendee Details' in line:
-                for j in range(i + 1, min(i + 5, len(lines))):
-                    if 'User Name' in lines[j] and 'Email' in lines[j]:
-                        header_idx = j
-                        break
-                if header_idx == -1 and i + 1 < len(lines):
-                    header_idx = i + 1
-                break
-
-        if header_idx == -1:
-            # Fallback: find any row with expected columns
-            for i, line in enumerate(lines):
-                if 'User Name' in line and 'Email' in line and 'Join Time' in line:
-                    header_idx = i
-                    break
-
-        if header_idx == -1:
-            return None, "Cannot find Attendee Details section in Zoom report"
-
-        # Extract header + data lines; strip trailing commas that create ghost columns
-        attendee_lines = []
-        for i in range(header_idx, len(lines)):
-            stripped = lines[i].strip()
-            if not stripped:
-                continue
-            if stripped.endswith(','):
-                stripped = stripped[:-1]
-            attendee_lines.append(stripped)
-
-        if len(attendee_lines) < 2:
-            return None, "No attendee data found after header"
-
-        csv_text = '\n'.join(attendee_lines)
-        df = pd.read_csv(StringIO(csv_text), skipinitialspace=True)
-    else:
-        # Excel: scan for the header row containing expected columns
-        df_raw = pd.read_excel(file_obj, header=None)
-        header_idx = 0
-        for i, row in df_raw.iterrows():
-            row_vals = [str(v) for v in row.values]
-            if any('User Name' in v for v in row_vals) and any('Email' in v for v in row_vals):
-                header_idx = i
-                break
-        if hasattr(file_obj, 'seek'):
-            file_obj.seek(0)
-        df = pd.read_excel(file_obj, header=header_idx)
-
-    # Drop completely empty columns (artefact of trailing commas)
-    df = df.dropna(axis=1, how='all')
-    return df, None
 
 # --- 3. 數據處理 ---
 df_final = pd.DataFrame()
 
-if reg_file and template_file:
+# 記錄本次執行各階段的耗時 (抓取 / 解析 / 核對 / 生成 / 轉檔 / 加密 / 打包)
+run_report = RunReport()
+
+if reg_file and template_files:
     if use_zoom and not zoom_file:
         st.warning("請上傳 Zoom 檔案或取消勾選核對選項。")
     else:
         st.header("3. 處理名單")
         try:
             # A. 讀取報名表
-            if reg_file.name.endswith('.csv'):
-                df_reg = pd.read_csv(reg_file)
-            else:
-                df_reg = pd.read_excel(reg_file)
-            
-            # --- 強化的欄位對應邏輯 ---
-            col_map = {}
-            has_full_name = False
-            
-            for c in df_reg.columns:
-                c_lower = str(c).lower().strip()
-                if 'full name' in c_lower:
-                    col_map[c] = 'Full Name'
-                    has_full_name = True
-                elif 'first name' in c_lower or '名字' in c_lower:
-                    col_map[c] = 'First Name'
-                elif 'last name' in c_lower or '姓氏' in c_lower:
-                    col_map[c] = 'Last Name'
-                elif 'contact email' in c_lower:
-                    col_map[c] = 'Email'
-                elif 'email' in c_lower or '電郵' in c_lower:
-                    col_map[c] = 'Email'
-                elif 'hkie membership' in c_lower or 'membership no' in c_lower or '會員編號' in c_lower:
-                    col_map[c] = 'Membership No'
-                elif 'salutation' in c_lower or '稱呼' in c_lower:
-                    col_map[c] = 'Salutation'
+            reg_digest = file_digest(reg_file)
+            with run_report.stage('parse'):
+                df_reg, missing_membership = load_registration(reg_digest, reg_file.getvalue(), reg_file.name)
             
-            df_reg.rename(columns=col_map, inplace=True)
-            
-            # 如果有 Full Name 但沒有 First Name / Last Name，需要拆分
-            if has_full_name and 'Full Name' in df_reg.columns:
-                if 'First Name' not in df_reg.columns or 'Last Name' not in df_reg.columns:
-                    # 拆分 Full Name 為 First Name 和 Last Name
-                    name_split = df_reg['Full Name'].astype(str).str.strip().str.split(n=1, expand=True)
-                    if name_split.shape[1] == 2:
-                        df_reg['First Name'] = name_split[0]
-                        df_reg['Last Name'] = name_split[1]
-                    else:
-                        # 如果只有一個詞，全部當作 First Name
-                        df_reg['First Name'] = name_split[0]
-                        df_reg['Last Name'] = ""
-            
-            # 檢查是否成功抓到 Membership No
-            if 'Membership No' not in df_reg.columns:
+            if missing_membership:
                 st.warning("⚠️ 警告：無法自動識別 'Membership No' 欄位。這可能導致證書上的會員編號為空白。請檢查 Excel 標題是否包含 'Membership' 或 '會員編號'。")
-                # 嘗試建立一個空的欄位以防報錯
-                df_reg['Membership No'] = ""
-            
-            # 如果沒有 Salutation 欄位，建立一個空的
-            if 'Salutation' not in df_reg.columns:
-                df_reg['Salutation'] = ""
             
-            required_cols = ['First Name', 'Last Name', 'Email']
-            if not all(col in df_reg.columns for col in required_cols):
-                st.error(f"報名表缺少必要欄位: {required_cols}")
+            if not all(col in df_reg.columns for col in REQUIRED_COLUMNS):
+                st.error(f"報名表缺少必要欄位: {REQUIRED_COLUMNS}")
                 st.write("目前偵測到的欄位:", df_reg.columns.tolist())
                 st.stop()
 
             # B. 核對 Zoom
             if not use_zoom:
-                df_final = df_reg.copy()
-                df_final['Full Name'] = df_final['First Name'].astype(str) + " " + df_final['Last Name'].astype(str)
-                df_final['Match Method'] = "Registration Only"
+                df_final = registration_only(df_reg)
             else:
                 # Parse Zoom attendee report
-                df_zoom, zoom_err = parse_zoom_report(zoom_file)
-                if zoom_err:
-                    st.error(f"Zoom 檔案解析失敗: {zoom_err}")
+                zoom_digest = file_digest(zoom_file)
+                with run_report.stage('parse'):
+                    zoom = load_zoom(zoom_digest, zoom_file.getvalue(), zoom_file.name)
+                if zoom['error']:
+                    st.error(f"Zoom 檔案解析失敗: {zoom['error']}")
                     st.stop()
 
-                st.write(f"📊 Zoom 檔案欄位: {df_zoom.columns.tolist()}")
-                st.write(f"📈 Zoom 原始資料筆數: {len(df_zoom)}")
-
-                z_user_col = next((c for c in df_zoom.columns if "User Name" in str(c)), None)
-                z_email_col = next((c for c in df_zoom.columns if "Email" in str(c)), None)
+                st.write(f"📊 Zoom 檔案欄位: {zoom['columns']}")
+                st.write(f"📈 Zoom 原始資料筆數: {zoom['raw_rows']}")
 
+                z_user_col, z_email_col = zoom['user_col'], zoom['email_col']
                 if not z_user_col or not z_email_col:
                     st.error("Zoom 檔案無法識別 User Name 或 Email 欄位。")
-                    st.write("偵測到的欄位:", df_zoom.columns.tolist())
+                    st.write("偵測到的欄位:", zoom['columns'])
                     st.stop()
 
-                # Aggregate total time in session per attendee (handles re-joins)
-                z_time_col = next((c for c in df_zoom.columns if "Time in Session" in str(c)), None)
-                if z_time_col:
-                    df_zoom[z_time_col] = pd.to_numeric(df_zoom[z_time_col], errors='coerce').fillna(0)
-                    time_agg = df_zoom.groupby(z_email_col, as_index=False)[z_time_col].sum()
-                    time_agg.rename(columns={z_time_col: '_total_time'}, inplace=True)
-                    df_zoom = df_zoom.drop_duplicates(subset=[z_email_col], keep='first')
-                    df_zoom = df_zoom.merge(time_agg, on=z_email_col, how='left')
-                    df_zoom[z_time_col] = df_zoom['_total_time']
-                    df_zoom.drop(columns=['_total_time'], inplace=True)
-                else:
-                    df_zoom = df_zoom.drop_duplicates(subset=[z_email_col], keep='first')
-
+                df_zoom = zoom['df']
                 st.write(f"✅ 去除重複後 (已合計出席時間): {len(df_zoom)} 位出席者")
 
                 st.write("正在核對 Zoom 資料...")
-                df_reg['Name_Norm'] = (df_reg['First Name'].astype(str) + " " + df_reg['Last Name'].astype(str)).apply(normalize_name)
-                df_reg['Email_Norm'] = df_reg['Email'].astype(str).str.lower().str.strip()
-                
-                df_zoom['Name_Norm'] = df_zoom[z_user_col].apply(normalize_name)
-                df_zoom['Email_Norm'] = df_zoom[z_email_col].astype(str).str.lower().str.strip()
-                
-                # 建立 Zoom 對應字典
-                zoom_email_map = df_zoom.set_index('Email_Norm')[z_user_col].to_dict()
-                zoom_name_map = df_zoom.set_index('Name_Norm')[z_user_col].to_dict()
-                
-                st.write(f"📧 Zoom Email 數量: {len(zoom_email_map)}")
-                st.write(f"👤 Zoom Name 數量: {len(zoom_name_map)}")
+                st.write(f"📧 Zoom Email 數量: {df_zoom['Email_Norm'].nunique(dropna=False)}")
+                st.write(f"👤 Zoom Name 數量: {df_zoom['Name_Norm'].nunique(dropna=False)}")
                 st.write(f"📝 報名表數量: {len(df_reg)}")
                 
                 # 顯示前幾筆 Zoom 資料供檢查
                 st.write("Zoom 資料預覽 (前5筆):")
                 st.dataframe(df_zoom[[z_user_col, z_email_col, 'Email_Norm']].head())
                 
-                matched_list = []
-                unmatched_list = []
+                with run_report.stage('match'):
+                    df_final, df_unmatched = match_lists(
+                        reg_digest, zoom_digest, match_names, name_threshold, df_reg, zoom,
+                    )
                 
-                for _, row in df_reg.iterrows():
-                    status = "Unmatched"
-                    if row['Email_Norm'] in zoom_email_map:
-                        status = "Matched (Email)"
-                    
-                    if "Matched" in status:
-                        matched_list.append({
-                            "Salutation": row.get('Salutation', ''),
-                            "Full Name": f"{row.get('First Name', '')} {row.get('Last Name', '')}",
-                            "Membership No": row.get('Membership No', ''),
-                            "Email": row.get('Email', ''),
-                            "Match Method": status
-                        })
-                    else:
-                        unmatched_list.append({
-                            "Name": f"{row.get('First Name', '')} {row.get('Last Name', '')}",
-                            "Email": row.get('Email', ''),
-                            "Email_Norm": row['Email_Norm'],
-                            "Name_Norm": row['Name_Norm']
-                        })
-                
-                df_final = pd.DataFrame(matched_list)
+                df_by_name = df_final[df_final['Match Method'] == "Matched (Name)"]
+                if not df_by_name.empty:
+                    # 以姓名配對的記錄須人手確認後才會發出證書
+                    st.info(f"👤 {len(df_by_name)} 筆以姓名配對 (Email 與 Zoom 不同)，請核對並勾選「確認」；未確認的不會發出證書：")
+                    review_cols = ['Full Name', 'Zoom Name', 'Email', 'Match Score']
+                    review = df_by_name[review_cols].copy()
+                    review.insert(0, '確認', False)
+                    review = st.data_editor(
+                        review, disabled=review_cols, hide_index=True,
+                        key=f"name_review_{reg_digest}_{zoom_digest}_{name_threshold}",
+                    )
+                    unconfirmed = review.index[~review['確認']]
+                    if len(unconfirmed):
+                        df_final = df_final.drop(index=unconfirmed)
+                        st.caption(f"{len(unconfirmed)} 筆未確認，暫不發出證書。")
                 
                 # 顯示未匹配的記錄
-                if unmatched_list:
-                    st.warning(f"⚠️ {len(unmatched_list)} 筆報名記錄未在 Zoom 中找到")
+                if not df_unmatched.empty:
+                    st.warning(f"⚠️ {len(df_unmatched)} 筆報名記錄未在 Zoom 中找到")
                     with st.expander("查看未匹配的記錄"):
-                        st.dataframe(pd.DataFrame(unmatched_list))
+                        st.dataframe(df_unmatched)
 
             if not df_final.empty:
                 st.success(f"共產生 {len(df_final)} 筆證書名單。")
@@ -331,121 +244,136 @@ if reg_file and template_file:
         ('Word 文件 (.docx) - 不加密', 'PDF 文件 (.pdf) - 加密 (密碼: Email)')
     )
     
+    pdf_backend = 'auto'
+    template_once = False
+    if output_format.startswith('PDF'):
+        # auto: Windows 有 Word 時用 Word，否則用 LibreOffice (soffice)
+        pdf_backend = st.selectbox("PDF 轉換引擎", BACKENDS)
+        # 只轉換一份基底 PDF，再把每位出席者的姓名 / 會員編號直接寫入 PDF 並加密
+        template_once = st.checkbox("快速模式：範本只轉換一次 (template-once)", value=False)
+    
+    # 以範本、證書內容及密碼的雜湊為鍵：重新生成時只處理新增或變更的出席者，中斷後亦可接續
+    use_cache = st.checkbox("使用證書快取 (只生成新增或變更的證書)", value=True)
+    
+    # cProfile 只看得到目前的進程，因此剖析時改為單一進程生成
+    profile_run = st.checkbox("以 cProfile 剖析本次生成 (單一進程，較慢)", value=False)
+    
     if st.button("開始生成"):
         if df_final.empty:
             st.error("名單為空。")
         else:
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
-            with tempfile.TemporaryDirectory() as tmpdirname:
-                zip_filename = "certs_output.zip"
-                zip_path = os.path.join(tmpdirname, zip_filename)
-                template_path = os.path.join(tmpdirname, "template.docx")
-                
-                with open(template_path, "wb") as f:
-                    f.write(template_file.getbuffer())
-                
-                generated_files = []
-                total = len(df_final)
-                success_count = 0
-                
-                # PDF 批次處理初始化
-                word = None
-                if output_format.startswith('PDF') and os.name == 'nt':
-                    try:
-                        pythoncom.CoInitialize()
-                        word = win32com.client.DispatchEx("Word.Application")
-                        word.Visible = False
-                        word.DisplayAlerts = False
-                    except Exception as e:
-                        st.error(f"無法啟動 Word: {e}")
-                        st.stop()
-                
-                try:
-                    for i, person in df_final.iterrows():
-                        person_name = str(person['Full Name']).strip()
-                        status_text.text(f"處理中 ({i+1}/{total}): {person_name}")
-                        
-                        try:
-                            # 1. 產生 DOCX
-                            doc_tpl = DocxTemplate(template_path)
-                            
-                            # 處理 Membership No (避免 NaN 或 .0)
-                            mem_no = str(person['Membership No'])
-                            if mem_no.lower() in ['nan', 'none', '']: 
-                                mem_no = ""
-                            if mem_no.endswith('.0'): # 去除 Excel 數字轉字串可能出現的 .0
-                                mem_no = mem_no[:-2]
-
-                            # 建立變數對應 (Context)
-                            # 注意：這裡使用 membership_no 對應新範本
-                            context = {
-                                'name': f"{person['Salutation']} {person_name}",
-                                'membership_no': mem_no,  # 對應 Word 中的 {{ membership_no }}
-                                'event_title': event_title,
-                                'event_details': event_details
-                            }
-                            doc_tpl.render(context)
-                            
-                            safe_name = re.sub(r'[\\/*?:"<>|]', "", person_name)
-                            docx_filename = f"{safe_name}.docx"
-                            docx_path = os.path.join(tmpdirname, docx_filename)
-                            doc_tpl.save(docx_path)
-                            
-                            final_file_path = docx_path
-                            
-                            # 2. 轉 PDF (若需要)
-                            if word:
-                                try:
-                                    pdf_filename = f"{safe_name}.pdf"
-                                    pdf_path = os.path.join(tmpdirname, pdf_filename)
-                                    
-                                    wb_doc = word.Documents.Open(os.path.abspath(docx_path))
-                                    wb_doc.SaveAs(os.path.abspath(pdf_path), FileFormat=17)
-                                    wb_doc.Close(SaveChanges=False)
-                                    
-                                    password = str(person['Email']).strip()
-                                    if not password or password == 'nan':
-                                        password = "hkie"
-                                        
-                                    encrypted_path = os.path.join(tmpdirname, f"Encrypted_{safe_name}.pdf")
-                                    with pikepdf.Pdf.open(pdf_path) as pdf:
-                                        pdf.save(encrypted_path, encryption=pikepdf.Encryption(owner=password, user=password, R=6))
-                                    
-                                    final_file_path = encrypted_path
-                                except Exception as e:
-                                    # st.warning(f"{person_name} 轉檔失敗: {e}")
-                                    final_file_path = docx_path
-                            
-                            generated_files.append(final_file_path)
-                            success_count += 1
-                            
-                        except Exception as e:
-                            st.error(f"生成 {person_name} 時錯誤: {e}")
-                            if "expected token" in str(e):
-                                st.stop()
-
-                        progress_bar.progress((i + 1) / total)
-                        
-                finally:
-                    if word:
-                        try:
-                            word.Quit()
-                        except:
-                            pass
-                        pythoncom.CoUninitialize()
-                
-                if generated_files:
-                    with zipfile.ZipFile(zip_path, 'w') as zipf:
-                        for file in generated_files:
-                            zipf.write(file, os.path.basename(file))
-                            
-                    with open(zip_path, "rb") as f:
-                        st.download_button(
-                            label=f"📥 下載完成 ({success_count} 個檔案)",
-                            data=f,
-                            file_name=zip_filename,
-                            mime="application/zip"
-                        )
-                    st.success("任務完成！")
\ No newline at end of file
+            # 活動頁的抓取耗時只計入抓取後的第一個工作
+            fetch_seconds = st.session_state.pop('fetch_seconds', None)
+            if fetch_seconds is not None:
+                run_report.add('fetch', fetch_seconds)
+            # 交給背景工作佇列生成，不佔用本頁面；重新整理頁面後仍可在下方查看進度及下載
+            options = dict(
+                stages=run_report.stages,
+                cache_dir=default_cache_dir() if use_cache else None,
+                profile=profile_run,
+                to_pdf=output_format.startswith('PDF'),
+                backend=pdf_backend,
+                template_once=template_once,
+            )
+            events = [(event_title, event_details)]
+            if bulk_events and use_bulk_events:
+                events = [(e['title'] or "", e['details'] or "") for e in bulk_events if not e['error']]
+            if len(template_files) == 1 and len(events) == 1:
+                job_id = job_queue().submit(
+                    event_title or template_files[0].name, df_final, template_files[0].getvalue(),
+                    event_title=event_title, event_details=event_details, **options,
+                )
+            else:
+                # 批量模式：一個 ZIP，每個活動 / 範本各一個資料夾；每個範本只編譯一次
+                job_id = job_queue().submit(
+                    f"{len(events)} 個活動 × {len(template_files)} 個範本", df_final,
+                    [(f.name, f.getvalue()) for f in template_files], events=events, **options,
+                )
+            st.success(f"已加入生成佇列 (工作 {job_id})，進度請見下方「5. 生成工作」。")
+
+
+# --- 5. 生成工作 ---
+STATE_LABELS = {'queued': '排隊中', 'running': '生成中', 'done': '完成', 'failed': '失敗',
+                'cancelled': '已取消'}
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def show_job(jobs, status):
+    job_id = status['id']
+    st.subheader(f"{status['label']} ({STATE_LABELS.get(status['state'], status['state'])})")
+    st.caption(f"工作 {job_id}")
+    if status['state'] in ACTIVE_STATES:
+        total = max(status['total'], 1)
+        text = f"處理中 ({status['done']}/{status['total']}): {status['current']}" if status['current'] else "等待中"
+        st.progress(min(status['done'] / total, 1.0), text=text)
+        if st.button("取消", key=f"cancel-{job_id}"):
+            jobs.cancel(job_id)
+            st.rerun()
+        return
+
+    if status['error']:
+        st.error(f"生成失敗: {status['error']}")
+    for name, message in status['errors'][:20]:
+        st.error(f"生成 {name} 時錯誤: {message}")
+    for name, message in status['warnings'][:20]:
+        st.warning(f"{name} 轉 PDF 失敗，已改為輸出 DOCX: {message}")
+
+    summary = status['summary']
+    if summary:
+        if summary['template_once'] is False:
+            st.info("此範本無法使用快速模式，已改為逐份轉換 PDF。")
+        if summary['backends']:
+            st.caption("輸出方式: " + ", ".join(f"{k} × {v}" for k, v in summary['backends'].items()))
+        zip_path = jobs.zip_path(job_id)
+        if summary['files'] and zip_path:
+            # 按下時才讀取 ZIP，避免每次更新頁面都載入所有工作的檔案
+            st.download_button(
+                label=f"📥 下載完成 ({summary['files']} 個檔案)",
+                data=lambda: read_file(zip_path),
+                file_name="certs_output.zip",
+                mime="application/zip",
+                key=f"download-{job_id}",
+            )
+            st.success("任務完成！")
+
+    # 效能報告：各階段耗時、每位出席者延遲百分位數、記憶體峰值
+    report = dict(status['report'] or {})
+    profile_text = report.pop('profile', None)
+    if report:
+        with st.expander("📈 效能報告"):
+            st.json(report)
+            st.download_button(
+                label="下載效能報告 (JSON)",
+                data=json.dumps(report, indent=2),
+                file_name="run_report.json",
+                mime="application/json",
+                key=f"report-{job_id}",
+            )
+            if profile_text:
+                st.text("cProfile (依累計時間排序):")
+                st.code(profile_text)
+    if st.button("刪除", key=f"remove-{job_id}"):
+        jobs.remove(job_id)
+        st.rerun()
+
+
+# 有工作排隊或進行中時每 2 秒自動更新
+jobs_active = any(s['state'] in ACTIVE_STATES for s in job_queue().jobs())
+
+
+@st.fragment(run_every=2 if jobs_active else None)
+def show_jobs():
+    jobs = job_queue()
+    statuses = jobs.jobs()
+    if not statuses:
+        st.caption("尚未有生成工作。")
+    for status in statuses:
+        show_job(jobs, status)
+
+
+st.header("5. 生成工作")
+show_jobs()
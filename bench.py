@@ -0,0 +1,324 @@
+"""Pipeline benchmark on synthetic data.
+
+Generates registration sheets (CSV / xlsx, English or Chinese headers) and
+Zoom attendee reports (several sections, re-joins, attendees who used a
+different email, guests who never registered), then times each stage on
+its own:
+
+    column_mapping    read the registration file and map its columns
+    parse_zoom        parse_zoom_report()
+    matching          merge re-joins, normalize and match_registration()
+    render            CompiledTemplate.render() per attendee
+    encrypt           encrypt_pdf_bytes() per attendee (one-page PDF)
+    zip               add_to_archive() per certificate into a temp file
+
+    python bench.py                          # 100, 1k, 10k and 100k rows
+    python bench.py --sizes 100 1000 --out bench_output.txt
+    python bench.py --baseline old.json      # exit 1 on a >25% slowdown
+
+Results are printed as JSON (one report per run). Rendering, encryption
+and zipping are measured on at most --render-limit attendees per size and
+reported per item as well, since they scale linearly.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+import openpyxl
+import pandas as pd
+import pikepdf
+
+from attendance import dedupe_zoom_attendees, normalize_emails, normalize_names, parse_zoom_report, zoom_columns
+from cert_engine import add_to_archive, build_jobs, encrypt_pdf_bytes
+from cert_template import CompiledTemplate
+from pipeline import match_registration
+from registration import load_registration
+
+SIZES = (100, 1000, 10000, 100000)
+RENDER_LIMIT = 500
+DEFAULT_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CPD_Template.docx')
+
+HEADERS = {
+    'en': ['Salutation', 'First Name', 'Last Name', 'Email', 'HKIE Membership No'],
+    'zh': ['稱呼', '名字', '姓氏', '電郵', '會員編號'],
+}
+ZOOM_HEADER = ['Attended', 'User Name (Original Name)', 'First Name', 'Last Name', 'Email',
+               'Registration Time', 'Approval Status', 'Join Time', 'Leave Time',
+               'Time in Session (minutes)', 'Is Guest', 'Country/Region Name']
+
+_SURNAMES = ['Chan', 'Wong', 'Lee', 'Cheung', 'Lau', 'Ho', 'Ng', 'Leung', 'Lam', 'Tsang',
+             'Yip', 'Kwok', 'Tang', 'Fung', 'Lo', 'Mak', 'Chow', 'Siu', 'Yeung', 'Poon']
+_SYLLABLES = ['Tai', 'Man', 'Ka', 'Wai', 'Siu', 'Ming', 'Chi', 'Kin', 'Yan', 'Hoi',
+              'Wing', 'Kit', 'Hung', 'Fai', 'Ling', 'Mei', 'Sze', 'Yee', 'Chun', 'Lok']
+_SALUTATIONS = ['Ir', 'Mr', 'Ms', 'Dr', 'Prof', '']
+
+
+# --- Fixtures ---
+
+def make_registration(n, lang='en', seed=0):
+    """Synthetic registration list with n rows and HEADERS[lang] columns."""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        given = f"{rng.choice(_SYLLABLES)} {rng.choice(_SYLLABLES)}"
+        surname = rng.choice(_SURNAMES)
+        email = f"{given.replace(' ', '').lower()}.{surname.lower()}{i}@example.com"
+        # Some members leave the number blank; Excel turns the rest into numbers
+        membership = '' if rng.random() < 0.1 else str(10000 + i)
+        rows.append([rng.choice(_SALUTATIONS), given, surname, email, membership])
+    return pd.DataFrame(rows, columns=HEADERS[lang])
+
+
+def write_registration(df_reg, path):
+    if path.endswith('.csv'):
+        df_reg.to_csv(path, index=False)
+    else:
+        df_reg.to_excel(path, index=False)
+    return path
+
+
+def _zoom_rows(df_reg, seed=0, attend=0.7, rejoin=0.2, other_email=0.05, guests=0.05):
+    """Attendee Details rows: most attendees join once with their registered
+    email, some re-join, some use another email, and a few never registered."""
+    rng = random.Random(seed)
+    given_col, surname_col, email_col = df_reg.columns[1], df_reg.columns[2], df_reg.columns[3]
+    rows = []
+    for given, surname, email in zip(df_reg[given_col], df_reg[surname_col], df_reg[email_col]):
+        if rng.random() >= attend:
+            continue
+        if rng.random() < other_email:
+            email = f"{given.replace(' ', '').lower()}{rng.randrange(1000)}@gmail.com"
+        name = f"{given} {surname}"
+        joins = 2 if rng.random() < rejoin else 1
+        for _ in range(joins):
+            rows.append(['Yes', name, given, surname, email.upper() if rng.random() < 0.1 else email,
+                         '2024-05-01 09:00', 'approved', '2024-05-02 19:00', '2024-05-02 20:00',
+                         rng.randrange(5, 90), 'No', 'Hong Kong'])
+    for g in range(int(len(df_reg) * guests)):
+        rows.append(['Yes', f"Guest {g}", 'Guest', str(g), f"guest{g}@example.org",
+                     '', '', '2024-05-02 19:00', '2024-05-02 20:00', rng.randrange(5, 90), 'Yes', ''])
+    rng.shuffle(rows)
+    return rows
+
+
+def _zoom_sections(host_details=True):
+    # Everything Zoom puts above the attendee list
+    rows = [
+        ['Attendee Report'],
+        ['Report Generated:', '2024-05-03 10:00'],
+        ['Topic', 'Webinar ID', 'Actual Start Time', 'Actual Duration (minutes)'],
+        ['CPD Seminar', '123 4567 8901', '2024-05-02 19:00', 60],
+        [],
+    ]
+    if not host_details:
+        return rows + [['Attendee Details']]
+    return rows + [
+        ['Host Details'],
+        ['Attended', 'User Name (Original Name)', 'Email', 'Join Time', 'Leave Time'],
+        ['Yes', 'HKIE IT Division', 'it@example.org', '2024-05-02 18:50', '2024-05-02 20:05'],
+        [],
+        ['Panelist Details'],
+        ['Attended', 'User Name (Original Name)', 'Email', 'Join Time', 'Leave Time'],
+        ['Yes', 'Speaker', 'speaker@example.org', '2024-05-02 18:55', '2024-05-02 20:00'],
+        [],
+        ['Attendee Details'],
+    ]
+
+
+def write_zoom_report(df_reg, path, seed=0):
+    """Write a multi-section Zoom attendee report (.csv or .xlsx) for df_reg.
+
+    The Excel parser takes the first User Name / Email header row, so the
+    .xlsx report leaves out the host and panelist tables.
+    """
+    host_details = path.endswith('.csv')
+    rows = _zoom_sections(host_details) + [ZOOM_HEADER] + _zoom_rows(df_reg, seed=seed)
+    if path.endswith('.csv'):
+        with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+            for row in rows:
+                # Zoom ends every line with a comma
+                f.write(','.join(str(v) for v in row) + ',\n')
+    else:
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet()
+        for row in rows:
+            ws.append(row)
+        wb.save(path)
+    return path
+
+
+def make_pdf():
+    """A one-page PDF standing in for a converted certificate."""
+    buf = io.BytesIO()
+    with pikepdf.new() as pdf:
+        pdf.add_blank_page()
+        pdf.save(buf)
+    return buf.getvalue()
+
+
+# --- Timing ---
+
+class Stages:
+    """Collects {'stage': {'seconds': ..., 'items': ...}}."""
+
+    def __init__(self):
+        self.results = {}
+
+    def run(self, name, func, items):
+        """Time func(); items is a count or a function of func's result."""
+        started = time.perf_counter()
+        value = func()
+        seconds = time.perf_counter() - started
+        if callable(items):
+            items = items(value)
+        self.results[name] = {
+            'seconds': round(seconds, 6),
+            'items': items,
+            'per_item_ms': round(seconds * 1000 / items, 4) if items else None,
+        }
+        return value
+
+
+def bench_size(n, workdir, template_bytes, fmt='csv', lang='en', render_limit=RENDER_LIMIT, seed=0):
+    df_src = make_registration(n, lang=lang, seed=seed)
+    reg_path = write_registration(df_src, os.path.join(workdir, f'reg_{lang}_{n}.{fmt}'))
+    zoom_path = write_zoom_report(df_src, os.path.join(workdir, f'zoom_{n}.{fmt}'), seed=seed)
+
+    stages = Stages()
+    df_reg, _ = stages.run('column_mapping', lambda: load_registration(reg_path), n)
+    df_zoom, err = stages.run('parse_zoom', lambda: parse_zoom_report(zoom_path),
+                              lambda parsed: len(parsed[0]) if parsed[0] is not None else 0)
+    if err:
+        raise RuntimeError(err)
+
+    def match():
+        user_col, email_col, time_col = zoom_columns(df_zoom)
+        zoom = {'user_col': user_col, 'df': dedupe_zoom_attendees(df_zoom, email_col, time_col)}
+        zoom['df']['Name_Norm'] = normalize_names(zoom['df'][user_col])
+        zoom['df']['Email_Norm'] = normalize_emails(zoom['df'][email_col])
+        return match_registration(df_reg, zoom)
+
+    df_final, df_unmatched = stages.run('matching', match, n)
+
+    jobs = build_jobs(df_final.head(render_limit), "Benchmark Event", "2 May 2024 19:00 - 20:00")
+    template = CompiledTemplate(template_bytes)
+    docs = stages.run('render', lambda: [template.render(job['context']) for job in jobs], len(jobs))
+
+    pdf_bytes = make_pdf()
+    stages.run('encrypt', lambda: [encrypt_pdf_bytes(io.BytesIO(pdf_bytes), job['password']) for job in jobs],
+               len(jobs))
+
+    def archive():
+        with tempfile.TemporaryFile() as f, zipfile.ZipFile(f, 'w') as zipf:
+            for job, data in zip(jobs, docs):
+                add_to_archive(zipf, f"{job['safe_name']}.docx", data)
+
+    stages.run('zip', archive, len(jobs))
+
+    return {
+        'rows': n,
+        'format': fmt,
+        'headers': lang,
+        'zoom_rows': len(df_zoom),
+        'matched': len(df_final),
+        'matched_by_name': int((df_final['Match Method'] == "Matched (Name)").sum()),
+        'unmatched': len(df_unmatched),
+        'fast_path': template.fast_path,
+        'stages': stages.results,
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(report, baseline, tolerance):
+    """Return 'rows/format/headers stage: old -> new' lines for every stage
+    more than tolerance times slower (per item) than in baseline."""
+    old = {(r['rows'], r['format'], r['headers']): r for r in baseline['results']}
+    regressions = []
+    for r in report['results']:
+        key = (r['rows'], r['format'], r['headers'])
+        if key not in old:
+            continue
+        for stage, new in r['stages'].items():
+            before = old[key]['stages'].get(stage)
+            if not before or not before['seconds']:
+                continue
+            ratio = new['seconds'] / before['seconds']
+            if before['items'] and new['items']:
+                ratio = (new['seconds'] / new['items']) / (before['seconds'] / before['items'])
+            if ratio > tolerance:
+                regressions.append(f"{'/'.join(map(str, key))} {stage}: "
+                                   f"{before['seconds']:.4f}s -> {new['seconds']:.4f}s (x{ratio:.2f})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the certificate pipeline on synthetic data.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES))
+    parser.add_argument('--formats', nargs='+', choices=('csv', 'xlsx'), default=['csv', 'xlsx'])
+    parser.add_argument('--headers', nargs='+', choices=sorted(HEADERS), default=['en', 'zh'])
+    parser.add_argument('--template', default=DEFAULT_TEMPLATE)
+    parser.add_argument('--render-limit', type=int, default=RENDER_LIMIT,
+                        help="attendees rendered / encrypted / zipped per size (default: %(default)s)")
+    parser.add_argument('--keep', metavar='DIR', help="write the fixtures to DIR and keep them")
+    parser.add_argument('--out', help="also write the JSON report to this file")
+    parser.add_argument('--baseline', help="earlier JSON report to compare against")
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help="slowdown factor reported as a regression (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    with open(args.template, 'rb') as f:
+        template_bytes = f.read()
+
+    report = {
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': [],
+    }
+    with tempfile.TemporaryDirectory(prefix='cpd_bench_') as tmp:
+        workdir = args.keep or tmp
+        os.makedirs(workdir, exist_ok=True)
+        for n in args.sizes:
+            for fmt in args.formats:
+                for lang in args.headers:
+                    result = bench_size(n, workdir, template_bytes, fmt, lang, args.render_limit)
+                    report['results'].append(result)
+                    print(f"{n} rows {fmt}/{lang}: " + ", ".join(
+                        f"{k} {v['seconds']:.3f}s" for k, v in result['stages'].items()), file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""Persistent, content-addressed certificate cache.
+
+Each finished certificate is stored under a hash of everything that
+determines its bytes: the template, the render context, the output format
+and, for PDF, the password, the requested converter and whether the PDF
+is patched from a template-once base. A rerun after a crash, or after a late
+registration, therefore only renders the attendees that are new or whose
+details changed; the rest come straight from disk.
+
+Entries are plain files; a hit refreshes the file's modification time and
+the least recently used entries are deleted once the cache grows past
+max_bytes. Files are written to a temporary name and renamed, so an
+interrupted run never leaves a truncated certificate behind.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+DEFAULT_MAX_BYTES = 512 * 2 ** 20
+# Evict down to this fraction of max_bytes, so eviction does not run on every put
+_EVICT_TO = 0.9
+
+
+def default_cache_dir(name='certificates'):
+    """Per-user cache directory (%LOCALAPPDATA% on Windows, XDG elsewhere)."""
+    base = os.environ.get('LOCALAPPDATA') if os.name == 'nt' else os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'cpd-cert', name)
+
+
+def template_digest(template_bytes):
+    return hashlib.sha256(template_bytes).hexdigest()
+
+
+class CertificateCache:
+    """Size-bounded on-disk store of certificate bytes by content key."""
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in self._entries())
+
+    def key(self, digest, job, to_pdf, backend='auto', template_once=False):
+        """Cache key of job rendered from the template with sha256 digest.
+        For PDF, backend and template_once are the run's options: Word and
+        LibreOffice lay the page out differently, and a patched PDF has no
+        kerning, so changing either renders the certificates again."""
+        material = {
+            'template': digest,
+            'context': job['context'],
+            'format': 'pdf' if to_pdf else 'docx',
+            # The PDF is encrypted with the password, the DOCX is not
+            'password': job['password'] if to_pdf else None,
+            'backend': backend if to_pdf else None,
+            'template_once': bool(template_once) if to_pdf else False,
+        }
+        return hashlib.sha256(json.dumps(material, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _entries(self):
+        for sub in os.scandir(self.directory):
+            if sub.is_dir():
+                for entry in os.scandir(sub.path):
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        yield entry
+
+    def get(self, key):
+        """Return the cached bytes for key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self, target=None):
+        """Delete least recently used entries until the cache is below target
+        bytes (default: 90% of max_bytes)."""
+        if target is None:
+            target = int(self.max_bytes * _EVICT_TO)
+        entries = sorted(((e.stat().st_mtime, e.stat().st_size, e.path) for e in self._entries()))
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        self.evict(target=0)
@@ -0,0 +1,330 @@
+"""Certificate generation engine.
+
+Splits the attendee list into batches across a pool of worker processes.
+Each worker holds its own CompiledTemplate (and its own PDF converter) and
+does the render, the optional PDF conversion and the encryption; finished
+certificates come back to the caller as bytes, in attendee order, ready to
+be appended to the output ZIP.
+"""
+import io
+import functools
+import multiprocessing
+import multiprocessing.util
+import os
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import pikepdf
+
+from cert_template import CompiledTemplate
+from pdf_convert import ConversionError, get_converter
+from pdf_patch import PatchError, build_base_pdf
+
+# Below this many attendees the pool start-up costs more than it saves
+MIN_PARALLEL_JOBS = 8
+# Attendees per work unit; a LibreOffice worker converts each unit in one call
+BATCH_SIZE = 25
+
+_worker = {}
+
+
+# Back-to-back runs in one process (CLI batches, app reruns) reuse the
+# compiled template instead of re-parsing the same .docx
+@functools.lru_cache(maxsize=4)
+def _compiled_template(template_bytes):
+    return CompiledTemplate(template_bytes)
+
+
+def clean_membership_no(value):
+    # 處理 Membership No (避免 NaN 或 .0)
+    mem_no = str(value)
+    if mem_no.lower() in ['nan', 'none', '']:
+        mem_no = ""
+    if mem_no.endswith('.0'):  # 去除 Excel 數字轉字串可能出現的 .0
+        mem_no = mem_no[:-2]
+    return mem_no
+
+
+def build_jobs(df_final, event_title, event_details):
+    """Turn the final attendee DataFrame into picklable render jobs."""
+    jobs = []
+    for pos, person in enumerate(df_final.to_dict('records')):
+        person_name = str(person['Full Name']).strip()
+        password = str(person['Email']).strip()
+        if not password or password == 'nan':
+            password = "hkie"
+        jobs.append({
+            'index': pos,
+            'name': person_name,
+            'safe_name': re.sub(r'[\\/*?:"<>|]', "", person_name),
+            'password': password,
+            # 建立變數對應 (Context)，對應 Word 範本中的 {{ ... }}
+            'context': {
+                'name': f"{person['Salutation']} {person_name}",
+                'membership_no': clean_membership_no(person['Membership No']),
+                'event_title': event_title,
+                'event_details': event_details,
+            },
+        })
+    return jobs
+
+
+def is_fatal_error(message):
+    """A template syntax error fails every attendee, so the run is aborted."""
+    return "expected token" in message
+
+
+def _init_worker(templates, to_pdf, backend, base_pdfs=None):
+    _worker.clear()
+    _worker['templates'] = [_compiled_template(template_bytes) for template_bytes in templates]
+    _worker['backend'] = backend
+    _worker['base_pdfs'] = base_pdfs or {}
+    _worker['converter'] = None
+    _worker['converter_error'] = None
+    _worker['scratch'] = None
+
+    if to_pdf:
+        # Word / soffice only read files, so PDF mode needs a scratch directory
+        _worker['scratch'] = tempfile.mkdtemp(prefix='cpd_work_')
+        # With a base PDF the converter is only started for certificates
+        # that cannot be patched
+        if not _worker['base_pdfs']:
+            _start_converter()
+
+
+def _start_converter():
+    try:
+        _worker['converter'] = get_converter(_worker['backend'])
+    except ConversionError as e:
+        _worker['converter_error'] = str(e)
+
+
+def _init_pool_worker(templates, to_pdf, backend, base_pdfs=None):
+    _init_worker(templates, to_pdf, backend, base_pdfs)
+    # Runs when the pool shuts the worker process down
+    multiprocessing.util.Finalize(None, _close_worker, exitpriority=10)
+
+
+def _close_worker():
+    converter = _worker.pop('converter', None)
+    if converter:
+        converter.close()
+    scratch = _worker.pop('scratch', None)
+    if scratch:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def encrypt_pdf_bytes(pdf_file, password):
+    """Encrypt a PDF (path or file object) with password and return the bytes."""
+    buf = io.BytesIO()
+    with pikepdf.Pdf.open(pdf_file) as pdf:
+        pdf.save(buf, encryption=pikepdf.Encryption(owner=password, user=password, R=6))
+    return buf.getvalue()
+
+
+def prepare_base_pdf(template_bytes, jobs, backend='auto'):
+    """Convert the template-once base certificate (pdf_patch.BasePdf) for
+    jobs. Returns None when the template or converter output cannot be
+    patched; every certificate is then converted as usual."""
+    scratch = tempfile.mkdtemp(prefix='cpd_base_')
+    try:
+        with get_converter(backend) as converter:
+            return build_base_pdf(
+                _compiled_template(template_bytes), [job['context'] for job in jobs], converter, scratch,
+            )
+    except (ConversionError, PatchError, pikepdf.PdfError):
+        return None
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _render_batch(jobs):
+    """Render a batch of jobs, converting and encrypting it as one batch for PDF.
+
+    In template-once mode each PDF is patched from the base PDF and
+    encrypted in memory; only the certificates that cannot be patched go
+    through the docx render and conversion. Certificates are returned as
+    bytes; files written to the scratch directory for the converter are
+    removed before returning.
+    """
+    base_pdfs = _worker['base_pdfs']
+    results = []
+    pending = []    # (job, result) still to be rendered (and converted)
+    for job in jobs:
+        result = {'index': job['index'], 'name': job['name'], 'arcname': None, 'data': None,
+                  'error': None, 'fatal': False, 'backend': None, 'warning': None, 'timings': {}}
+        results.append(result)
+        base_pdf = base_pdfs.get(job.get('group'))
+        if base_pdf is not None:
+            started = time.perf_counter()
+            try:
+                result['data'] = base_pdf.render(job['context'], job['password'])
+            except (PatchError, pikepdf.PdfError):
+                pass
+            else:
+                result['arcname'] = f"Encrypted_{job['safe_name']}.pdf"
+                result['backend'] = f"{base_pdf.backend} (template-once)"
+                result['timings']['patch'] = time.perf_counter() - started
+                continue
+        pending.append((job, result))
+
+    if pending and base_pdfs and not (_worker['converter'] or _worker['converter_error']):
+        _start_converter()
+
+    for job, result in pending:
+        if _worker['converter_error']:
+            result['error'] = _worker['converter_error']
+            result['fatal'] = True
+        else:
+            started = time.perf_counter()
+            try:
+                result['data'] = _worker['templates'][job.get('template', 0)].render(job['context'])
+                result['arcname'] = f"{job['safe_name']}.docx"
+            except Exception as e:
+                result['error'] = str(e)
+                result['fatal'] = is_fatal_error(result['error'])
+            result['timings']['render'] = time.perf_counter() - started
+
+    converter = _worker['converter']
+    if not converter:
+        return results
+
+    # Convert the batch, then encrypt each PDF in memory with its password;
+    # a failed conversion keeps the DOCX and reports why
+    rendered = [(job, res) for job, res in pending if res['data']]
+    docx_paths = []
+    for job, res in rendered:
+        # Named by index: attendees may share a name within one batch
+        docx_path = os.path.join(_worker['scratch'], f"{job['index']}.docx")
+        with open(docx_path, 'wb') as f:
+            f.write(res['data'])
+        docx_paths.append(docx_path)
+
+    started = time.perf_counter()
+    converted = converter.convert(docx_paths, _worker['scratch'])
+    # A batch is converted in one call; each file is charged an equal share
+    convert_share = (time.perf_counter() - started) / max(1, len(docx_paths))
+    for (job, res), docx_path, (pdf_path, error) in zip(rendered, docx_paths, converted):
+        _remove(docx_path)
+        res['timings']['convert'] = convert_share
+        if error:
+            res['warning'] = f"{converter.name}: {error}"
+            continue
+        started = time.perf_counter()
+        try:
+            res['data'] = encrypt_pdf_bytes(pdf_path, job['password'])
+            res['arcname'] = f"Encrypted_{job['safe_name']}.pdf"
+            res['backend'] = converter.name
+        except Exception as e:
+            res['warning'] = f"encrypt: {e}"
+        finally:
+            _remove(pdf_path)
+            res['timings']['encrypt'] = time.perf_counter() - started
+    return results
+
+
+def cached_result(job, data, to_pdf):
+    """Result dict, as generate_certificates() yields it, for a certificate
+    served from the certificate cache (see cert_cache)."""
+    arcname = f"Encrypted_{job['safe_name']}.pdf" if to_pdf else f"{job['safe_name']}.docx"
+    return {'index': job['index'], 'name': job['name'], 'arcname': arcname, 'data': data,
+            'error': None, 'fatal': False, 'backend': 'cache', 'warning': None, 'timings': {}}
+
+
+def generate_certificates(jobs, template_bytes, to_pdf=False, workers=None,
+                          backend='auto', batch_size=None, base_pdf=None):
+    """Render jobs and yield one result dict per job, in order.
+
+    Each result has 'index', 'name', 'arcname' and 'data' (the certificate
+    file name and bytes; None on failure), 'error', 'fatal', 'backend' (the
+    PDF converter used, None for DOCX), 'warning' (why a PDF could not be
+    produced; the DOCX is returned instead) and 'timings' (seconds spent in
+    the worker on 'render', 'convert' and 'encrypt', or on 'patch' for a
+    PDF patched from base_pdf, see prepare_base_pdf). At most two batches
+    per worker are in flight, which bounds memory whatever the attendee
+    count. Stop iterating (or close the generator) to cancel the batches
+    not yet started; the caller does this on a fatal result.
+
+    For several templates in one run, template_bytes is a list and each
+    job names its template by position ('template', default 0); base_pdf
+    is then a dict of BasePdf by the jobs' 'group' key. Every worker
+    compiles each template once.
+    """
+    if not jobs:
+        # Every certificate came from the cache: start no worker or converter
+        return
+    templates = [template_bytes] if isinstance(template_bytes, bytes) else list(template_bytes)
+    if isinstance(base_pdf, dict):
+        base_pdfs = base_pdf
+    else:
+        base_pdfs = {None: base_pdf} if base_pdf is not None else {}
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(jobs)))
+    if batch_size is None:
+        batch_size = max(1, min(BATCH_SIZE, -(-len(jobs) // (workers * 2))))
+    batches = iter([jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)])
+
+    if workers == 1 or len(jobs) < MIN_PARALLEL_JOBS:
+        _init_worker(templates, to_pdf, backend, base_pdfs)
+        try:
+            for batch in batches:
+                yield from _render_batch(batch)
+        finally:
+            _close_worker()
+        return
+
+    # spawn: never fork the (threaded) Streamlit server, and it matches Windows
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_pool_worker,
+        initargs=(templates, to_pdf, backend, base_pdfs),
+    )
+    try:
+        pending = deque(executor.submit(_render_batch, b) for b in islice(batches, workers * 2))
+        while pending:
+            batch_results = pending.popleft().result()
+            for batch in islice(batches, 1):
+                pending.append(executor.submit(_render_batch, batch))
+            yield from batch_results
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _in_archive(zipf, arcname):
+    try:
+        zipf.getinfo(arcname)
+        return True
+    except KeyError:
+        return False
+
+
+def add_to_archive(zipf, arcname, data):
+    """Append one certificate to an open ZipFile and return the name used.
+
+    PDFs are already compressed and are stored as-is; DOCX (and anything
+    else) is deflated. A repeated name gets a " (2)", " (3)", ... suffix
+    instead of producing a duplicate entry.
+    """
+    stem, ext = os.path.splitext(arcname)
+    n = 1
+    while _in_archive(zipf, arcname):
+        n += 1
+        arcname = f"{stem} ({n}){ext}"
+    compress_type = zipfile.ZIP_STORED if ext.lower() == '.pdf' else zipfile.ZIP_DEFLATED
+    zipf.writestr(arcname, data, compress_type=compress_type)
+    return arcname
@@ -0,0 +1,288 @@
+"""Compiled certificate templates.
+
+DocxTemplate unzips the .docx and re-parses its Jinja XML on every render.
+CompiledTemplate does that work once per template and renders each attendee
+by substituting the context into the cached document parts. Parts that only
+hold {{ name }} placeholders are rendered by splicing the escaped values
+between precomputed XML chunks, and the members that do not change are
+copied into the output still compressed.
+"""
+import io
+import re
+import struct
+import zipfile
+import zlib
+
+from docxtpl import DocxTemplate
+from jinja2 import Environment, TemplateError, nodes
+from markupsafe import escape
+
+# Parts docxtpl runs through Jinja: main body, headers, footers and footnotes
+_RENDERED_TYPES = ('document.main+xml', 'header+xml', 'footer+xml', 'footnotes+xml')
+_CORE_PROPS = 'docProps/core.xml'
+
+# Characters in a value that docxtpl post-processes after Jinja (line breaks,
+# tabs, paragraph and page breaks, escaped braces); such values take the
+# Jinja path so the output stays identical
+_LISTING_CHARS = re.compile('[\t\a\n\f{}]')
+# Stand-in for the i-th placeholder; NUL cannot occur in XML
+_MARK = '\x00{}\x00'
+_MARK_RE = re.compile('\x00(\\d+)\x00')
+
+_LOCAL_SIG = b'PK\x03\x04'
+_CENTRAL_SIG = b'PK\x01\x02'
+_END_SIG = b'PK\x05\x06'
+_END_STRUCT = '<4s4H2LH'
+_DATA_DESCRIPTOR = 0x08
+
+
+def read_template_bytes(template_file):
+    if isinstance(template_file, (bytes, bytearray)):
+        return bytes(template_file)
+    if hasattr(template_file, 'getvalue'):
+        return template_file.getvalue()
+    if hasattr(template_file, 'read'):
+        if hasattr(template_file, 'seek'):
+            template_file.seek(0)
+        return template_file.read()
+    with open(template_file, 'rb') as f:
+        return f.read()
+
+
+def _rendered_part_names(content_types_xml):
+    """Return zip member names of the parts docxtpl would render."""
+    names = set()
+    for m in re.finditer(r'<Override\b[^>]*>', content_types_xml):
+        tag = m.group(0)
+        part = re.search(r'PartName="/([^"]+)"', tag)
+        ctype = re.search(r'ContentType="([^"]+)"', tag)
+        if part and ctype and ctype.group(1).endswith(_RENDERED_TYPES):
+            names.add(part.group(1))
+    return names
+
+
+def _renumber_docpr_ids(xml):
+    """Same renumbering as DocxTemplate.fix_docpr_ids, done once at compile time."""
+    counter = [1000]
+
+    def bump(m):
+        counter[0] += 1
+        return f'{m.group(1)}{counter[0]}{m.group(3)}'
+
+    return re.sub(r'(<wp:docPr\b[^>]*?\bid=")(\d+)(")', bump, xml)
+
+
+def _placeholder_names(env, xml):
+    """Names used by xml if it is only text and {{ name }} placeholders,
+    else None."""
+    names = []
+    for node in env.parse(xml).body:
+        if not isinstance(node, nodes.Output):
+            return None
+        for child in node.nodes:
+            if isinstance(child, nodes.Name) and child.name not in env.globals:
+                if child.name not in names:
+                    names.append(child.name)
+            elif not isinstance(child, nodes.TemplateData):
+                return None
+    return names
+
+
+def _raw_members(template_bytes):
+    """Split a zip into {name: (local entry, central directory record)}, the
+    local entry being the header and compressed data exactly as stored.
+    Returns None for archives this does not handle (zip64, spanned, or with
+    data before the first entry)."""
+    end = template_bytes.rfind(_END_SIG)
+    if end < 0 or len(template_bytes) - end < struct.calcsize(_END_STRUCT):
+        return None
+    (_, disk, cd_disk, _, count, cd_size, cd_offset, _) = struct.unpack_from(_END_STRUCT, template_bytes, end)
+    if disk or cd_disk or count == 0xFFFF or cd_offset == 0xFFFFFFFF or cd_offset + cd_size != end:
+        return None
+
+    members = {}
+    pos = cd_offset
+    for _ in range(count):
+        if template_bytes[pos:pos + 4] != _CENTRAL_SIG:
+            return None
+        flags, = struct.unpack_from('<H', template_bytes, pos + 8)
+        compress_size, = struct.unpack_from('<L', template_bytes, pos + 20)
+        name_len, extra_len, comment_len = struct.unpack_from('<3H', template_bytes, pos + 28)
+        offset, = struct.unpack_from('<L', template_bytes, pos + 42)
+        record_end = pos + 46 + name_len + extra_len + comment_len
+        central = template_bytes[pos:record_end]
+        name = central[46:46 + name_len].decode('utf-8' if flags & 0x800 else 'cp437')
+
+        if template_bytes[offset:offset + 4] != _LOCAL_SIG:
+            return None
+        local_name_len, local_extra_len = struct.unpack_from('<2H', template_bytes, offset + 26)
+        data_end = offset + 30 + local_name_len + local_extra_len + compress_size
+        if flags & _DATA_DESCRIPTOR:
+            data_end += 16 if template_bytes[data_end:data_end + 4] == b'PK\x07\x08' else 12
+        members[name] = (template_bytes[offset:data_end], central)
+        pos = record_end
+    return members
+
+
+def _deflated_entry(local, central, data):
+    """Local entry and central record for data replacing a member, compressed
+    as zipfile.ZIP_DEFLATED does; name, date and attributes are kept."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    version, = struct.unpack_from('<H', local, 4)
+    flags, = struct.unpack_from('<H', local, 6)
+    fields = struct.pack('<2H', flags & ~_DATA_DESCRIPTOR, zipfile.ZIP_DEFLATED)
+    sizes = struct.pack('<3L', zlib.crc32(data), len(compressed), len(data))
+    name_len, extra_len = struct.unpack_from('<2H', local, 26)
+    header = (local[:4] + struct.pack('<H', max(version, 20)) + fields + local[10:14] + sizes
+              + local[26:30 + name_len + extra_len])
+    central = central[:6] + struct.pack('<H', max(version, 20)) + fields + central[12:16] + sizes + central[28:]
+    return header + compressed, central
+
+
+class CompiledTemplate:
+    """A certificate template parsed once and rendered many times.
+
+    The fast path keeps every zip member in memory and a compiled Jinja
+    template for each part that contains placeholders. Templates using Jinja
+    statements or comments ({% %}, {# #}) — table loops, colspan, paragraph
+    tags — or placeholders in the document properties need docxtpl's
+    post-processing and fall back to a full DocxTemplate render.
+
+    Parts whose placeholders are all plain {{ name }} (including ones Word
+    split across runs, which patch_xml merges) are also kept as the XML
+    chunks between placeholders, precomputed by rendering the part once
+    with markers. Rendering them joins those chunks with the escaped values,
+    and unchanged members are copied as stored rather than recompressed.
+    The resulting parts are the same as Jinja's; values with line breaks,
+    tabs or braces, which docxtpl post-processes, still go through Jinja.
+
+    Values are XML-escaped on both paths, so names such as "A & B" no longer
+    corrupt the document.
+    """
+
+    def __init__(self, template_file):
+        self.template_bytes = read_template_bytes(template_file)
+        self.fast_path = False
+        self._members = []      # [(ZipInfo, bytes)] in original order
+        self._compiled = {}     # member name -> jinja Template
+        self._spliced = {}      # member name -> (XML chunks as bytes, placeholder names)
+        self._raw = None        # member name -> (local entry, central record), as stored
+        try:
+            self._compile()
+            self.fast_path = True
+        except (TemplateError, KeyError, zipfile.BadZipFile):
+            # Let the full path report the problem on render, as before
+            self._members = []
+            self._compiled = {}
+            self._spliced = {}
+
+    def _compile(self):
+        helper = DocxTemplate(io.BytesIO(self.template_bytes))
+        env = Environment(autoescape=True)
+
+        with zipfile.ZipFile(io.BytesIO(self.template_bytes)) as zin:
+            content_types = zin.read('[Content_Types].xml').decode('utf-8')
+            rendered = _rendered_part_names(content_types)
+            for info in zin.infolist():
+                self._members.append((info, zin.read(info.filename)))
+
+        for info, data in self._members:
+            if info.filename == _CORE_PROPS and re.search(rb'\{[{%#]', data):
+                raise TemplateError('placeholders in document properties')
+            if info.filename not in rendered:
+                continue
+            xml = helper.patch_xml(data.decode('utf-8'))
+            if '{%' in xml or '{#' in xml:
+                raise TemplateError('template statements need the full renderer')
+            if info.filename.startswith('word/document'):
+                xml = _renumber_docpr_ids(xml)
+            if '{{' in xml:
+                self._compiled[info.filename] = env.from_string(xml)
+                self._compile_splice(info.filename, env, xml, helper)
+
+        self._helper = helper
+        raw = _raw_members(self.template_bytes)
+        if raw is not None and set(raw) == {info.filename for info, _ in self._members}:
+            self._raw = raw
+
+    def _compile_splice(self, name, env, xml, helper):
+        names = _placeholder_names(env, xml)
+        if not names:
+            return
+        # Rendering with markers applies Jinja's own newline handling to the chunks
+        marked = self._compiled[name].render({n: _MARK.format(i) for i, n in enumerate(names)})
+        marked = marked.replace('{_{', '{{').replace('}_}', '}}')
+        if helper.resolve_listing(marked) != marked:
+            return
+        pieces = _MARK_RE.split(marked)
+        chunks = [piece.encode('utf-8') for piece in pieces[::2]]
+        order = [names[int(i)] for i in pieces[1::2]]
+        self._spliced[name] = (chunks, order)
+
+    def _splice_part(self, name, context):
+        """Spliced XML of a part, or None if a value needs docxtpl's post-processing."""
+        chunks, order = self._spliced[name]
+        values = {}
+        for n in set(order):
+            # Same text as Jinja's autoescape; a missing name renders empty
+            value = str(escape(context[n])) if n in context else ''
+            if _LISTING_CHARS.search(value):
+                return None
+            values[n] = value.encode('utf-8')
+        out = [chunks[0]]
+        for n, chunk in zip(order, chunks[1:]):
+            out.append(values[n])
+            out.append(chunk)
+        return b''.join(out)
+
+    def _render_part(self, name, context):
+        if name in self._spliced:
+            data = self._splice_part(name, context)
+            if data is not None:
+                return data
+        xml = self._compiled[name].render(context)
+        xml = xml.replace('{_{', '{{').replace('}_}', '}}')
+        return self._helper.resolve_listing(xml).encode('utf-8')
+
+    def render(self, context):
+        """Render one certificate and return the .docx file as bytes."""
+        buf = io.BytesIO()
+        if not self.fast_path:
+            doc_tpl = DocxTemplate(io.BytesIO(self.template_bytes))
+            doc_tpl.render(context, autoescape=True)
+            doc_tpl.save(buf)
+            return buf.getvalue()
+
+        if self._raw is not None:
+            return self._render_raw(context)
+
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zout:
+            for info, data in self._members:
+                if info.filename in self._compiled:
+                    data = self._render_part(info.filename, context)
+                zout.writestr(info.filename, data)
+        return buf.getvalue()
+
+    def _render_raw(self, context):
+        """Write the zip by hand: rendered parts deflated, the rest as stored."""
+        entries, centrals = [], []
+        offset = 0
+        for info, _ in self._members:
+            local, central = self._raw[info.filename]
+            if info.filename in self._compiled:
+                local, central = _deflated_entry(local, central, self._render_part(info.filename, context))
+            entries.append(local)
+            centrals.append(central[:42] + struct.pack('<L', offset) + central[46:])
+            offset += len(local)
+        directory = b''.join(centrals)
+        end = struct.pack(_END_STRUCT, _END_SIG, 0, 0, len(centrals), len(centrals),
+                          len(directory), offset, 0)
+        return b''.join(entries) + directory + end
+
+    def save(self, context, filename):
+        """Render one certificate and write it to filename."""
+        data = self.render(context)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
@@ -0,0 +1,231 @@
+"""Headless certificate generation.
+
+One event:
+
+    python cli.py --registration reg.xlsx --template cert.docx --zoom zoom.csv \
+        --url "http://it.hkie.org.hk/...EventID=600" --out certs.zip --pdf
+
+Several events back to back in one process, from a JSON manifest (a list
+of objects using the long option names, e.g. {"registration": ...,
+"template": ..., "zoom": ..., "title": ..., "out": ...}):
+
+    python cli.py --manifest events.json
+
+Options given on the command line are defaults for every manifest entry.
+--fetch-events fetches the title and date of many events concurrently and
+prints them as the start of such a manifest:
+
+    python cli.py --fetch-events 600 601 602 > events.json
+
+One attendee list for several templates and / or events in one pass
+(parsed and matched once, one ZIP with an <event>/<template>/ folder each):
+
+    python cli.py --registration reg.xlsx --zoom zoom.csv --url 600 601 \
+        --template CPD_Template.docx "CPD_Template - ITD_END.docx" --out batch.zip
+
+A manifest entry can list "template" and "url" the same way, or give
+"events" as a list of {"url": ..., "title": ..., "details": ...}.
+
+--report writes per-stage timings, counters, latency percentiles and peak
+memory for every event; --profile runs the first event under cProfile.
+Finished certificates are kept in an on-disk cache (--cache-dir), so a
+rerun only renders attendees that are new or changed and an interrupted
+run resumes where it stopped; --no-cache turns this off.
+Streamlit and the Word COM libraries are never imported (PDF export uses
+LibreOffice unless --backend word is given on Windows).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from pdf_convert import BACKENDS
+
+# Keys a manifest entry may set, matching the argparse dests below ('events' is manifest only)
+EVENT_KEYS = ('registration', 'template', 'zoom', 'url', 'title', 'details', 'events', 'out',
+              'pdf', 'template_once', 'backend', 'workers', 'match_names', 'name_threshold')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Generate HKIE CPD certificates into a ZIP file.")
+    parser.add_argument('--registration', help="registration CSV / Excel file")
+    parser.add_argument('--template', nargs='+',
+                        help="certificate template (.docx); several put each template in its own folder")
+    parser.add_argument('--zoom', help="Zoom attendee report (CSV / Excel); omit to certify every registrant")
+    parser.add_argument('--url', nargs='+',
+                        help="HKIE event page (or EventID) to read the title and date from; "
+                             "several certify the same attendees for each event, in its own folder")
+    parser.add_argument('--title', help="event title (overrides --url)")
+    parser.add_argument('--details', help="event date and time (overrides --url)")
+    parser.add_argument('--out', default='certs_output.zip', help="output ZIP (default: %(default)s)")
+    parser.add_argument('--pdf', action='store_true', default=None, help="encrypted PDF instead of Word")
+    parser.add_argument('--template-once', action='store_true', default=None,
+                        help="PDF: convert one base certificate and patch each attendee into it")
+    parser.add_argument('--backend', choices=BACKENDS, default=None, help="PDF converter (default: auto)")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--name-match', dest='match_names', action='store_true', default=None,
+                        help="also match Zoom attendees by name when their email differs "
+                             "(unconfirmed: review the log)")
+    parser.add_argument('--no-name-match', dest='match_names', action='store_false', default=None,
+                        help="match Zoom attendees by email only (the default)")
+    parser.add_argument('--name-threshold', type=float, default=None, help="name similarity threshold")
+    parser.add_argument('--cache-dir', help="certificate cache directory (default: per-user cache)")
+    parser.add_argument('--cache-size', type=int, default=512, metavar='MB',
+                        help="evict least recently used certificates above this size (default: %(default)s)")
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help="always render every certificate")
+    parser.add_argument('--fetch-events', nargs='+', metavar='EVENT',
+                        help="print a manifest with the title and date of these EventIDs / URLs and exit")
+    parser.add_argument('--manifest', help="JSON list of events to run one after another")
+    parser.add_argument('--report', help="write the timing report of every event to this JSON file")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="run under cProfile (in-process unless --workers is given) and save the stats")
+    parser.add_argument('-q', '--quiet', action='store_true', help="only print errors")
+    return parser
+
+
+def load_events(args):
+    defaults = {key: getattr(args, key, None) for key in EVENT_KEYS}
+    if not args.manifest:
+        return [defaults]
+
+    with open(args.manifest, encoding='utf-8') as f:
+        entries = json.load(f)
+    base = os.path.dirname(os.path.abspath(args.manifest))
+    events = []
+    for n, entry in enumerate(entries, 1):
+        unknown = set(entry) - set(EVENT_KEYS)
+        if unknown:
+            raise SystemExit(f"{args.manifest}: event {n} has unknown keys {sorted(unknown)}")
+        event = dict(defaults)
+        event.update({k: v for k, v in entry.items() if v is not None})
+        # Manifest paths are relative to the manifest file
+        for key in ('registration', 'template', 'zoom', 'out'):
+            if event[key] and key in entry:
+                if isinstance(event[key], list):
+                    event[key] = [os.path.join(base, path) for path in event[key]]
+                else:
+                    event[key] = os.path.join(base, event[key])
+        if 'out' not in entry:
+            # Keep events without their own output from overwriting each other
+            stem, ext = os.path.splitext(args.out)
+            event['out'] = f"{stem}_{n}{ext}"
+        events.append(event)
+    return events
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def run(event, log, report, profile=False, cache=None):
+    # Imported here so that --help and argument errors return immediately
+    from attendance import NAME_MATCH_THRESHOLD
+    from pipeline import run_event
+
+    for key in ('registration', 'template'):
+        if not event[key]:
+            raise SystemExit(f"--{key} is required")
+    # --template / --url take several values; a manifest may give one or a list
+    templates = _as_list(event['template'])
+    urls = _as_list(event['url'])
+    events = event['events']
+    if events is None and len(urls) > 1:
+        events = [{'url': url} for url in urls]
+    # Written next to out and renamed on success: a failed run must not
+    # touch an existing file at out
+    kwargs = dict(
+        registration=event['registration'], out=event['out'] + '.part', zoom=event['zoom'],
+        template=templates[0] if len(templates) == 1 else templates,
+        event_url=urls[0] if urls else None, events=events,
+        event_title=event['title'], event_details=event['details'],
+        to_pdf=bool(event['pdf']), backend=event['backend'] or 'auto',
+        template_once=bool(event['template_once']),
+        workers=event['workers'],
+        match_names=bool(event['match_names']),
+        name_threshold=event['name_threshold'] or NAME_MATCH_THRESHOLD,
+        log=log, report=report, cache=cache,
+    )
+    if not profile:
+        summary = run_event(**kwargs)
+    else:
+        # cProfile only sees this process, so profile the in-process path
+        kwargs['workers'] = kwargs['workers'] or 1
+        summary = report.profiled(run_event, **kwargs)
+    os.replace(kwargs['out'], event['out'])
+    return summary
+
+
+def fetch_manifest(events):
+    from event_info import fetch_events
+
+    manifest = []
+    failed = 0
+    for event in fetch_events(events):
+        if event['error']:
+            failed += 1
+            print(f"{event['url']}: failed: {event['error']}", file=sys.stderr)
+        else:
+            manifest.append({'url': event['url'], 'title': event['title'], 'details': event['details']})
+    json.dump(manifest, sys.stdout, indent=2)
+    print()
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.fetch_events:
+        return fetch_manifest(args.fetch_events)
+    events = load_events(args)
+
+    def log(message):
+        if not args.quiet:
+            print(f"  {message}", file=sys.stderr)
+
+    from run_report import RunReport
+
+    cache = None
+    if args.cache:
+        from cert_cache import CertificateCache
+        cache = CertificateCache(args.cache_dir, max_bytes=args.cache_size * 2 ** 20)
+
+    failed = 0
+    reports = []
+    profiler = None
+    for n, event in enumerate(events, 1):
+        label = event['out'] if len(events) == 1 else f"[{n}/{len(events)}] {event['out']}"
+        started = time.perf_counter()
+        report = RunReport()
+        try:
+            summary = run(event, log, report, profile=bool(args.profile) and n == 1, cache=cache)
+        except Exception as e:
+            failed += 1
+            print(f"{label}: failed: {e}", file=sys.stderr)
+            try:
+                os.remove(event['out'] + '.part')
+            except OSError:
+                pass
+            continue
+        finally:
+            profiler = profiler or report.profiler
+            reports.append(dict(report.as_dict(), out=event['out']))
+        backends = ", ".join(f"{k} x {v}" for k, v in summary['backends'].items())
+        print(f"{label}: {summary['files']}/{summary['certificates']} certificates ({backends}) "
+              f"in {time.perf_counter() - started:.1f}s")
+        if summary['errors']:
+            failed += 1
+
+    if args.report:
+        for report in reports:
+            report.pop('profile', None)
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, indent=2)
+    if profiler:
+        profiler.dump_stats(args.profile)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+"""HKIE event page scraping.
+
+Pages are fetched through one pooled requests.Session with timeouts and
+retries. Each page's title and date are kept on disk with the response's
+ETag / Last-Modified, so fetching it again is a conditional request that
+the server can answer with 304 Not Modified. The HTML is parsed as it
+streams in and the download stops as soon as both elements are complete.
+fetch_events() fetches many events concurrently.
+"""
+import codecs
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cert_cache import default_cache_dir
+
+TITLE_ID = "ctl00_ContentPlaceHolder1_ContentName"
+DETAILS_ID = "ctl00_ContentPlaceHolder1_dtv"
+EVENT_URL = "http://it.hkie.org.hk/en_it_events_inside_Past.aspx?EventID={}&&TypeName=Events+%2f+Activities"
+
+# (connect, read) seconds
+TIMEOUT = (5, 20)
+FETCH_WORKERS = 8
+_CHUNK_SIZE = 16 * 1024
+
+# Elements without an end tag: nothing to capture inside them
+_VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+              'param', 'source', 'track', 'wbr'}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """The shared Session: keep-alive connection pool, retries on connection
+    errors and 5xx responses."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504),
+                          allowed_methods=('GET',))
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=FETCH_WORKERS, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+def event_url(event):
+    """URL of an event given as an EventID (int or digits) or a full URL."""
+    event = str(event).strip()
+    return EVENT_URL.format(event) if event.isdigit() else event
+
+
+class _EventPageParser(HTMLParser):
+    """Collects the text of the title and details elements; `done` is set
+    once both have been closed.
+
+    Only tags with the captured element's own name count towards its
+    nesting depth: end tags that HTML lets pages omit (</td>, </tr>, </p>,
+    </li>) must not keep the element open.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.texts = {TITLE_ID: None, DETAILS_ID: None}
+        self._open = {}     # element id -> [tag, depth, text pieces]
+
+    @property
+    def done(self):
+        return not self._open and all(text is not None for text in self.texts.values())
+
+    def handle_starttag(self, tag, attrs):
+        for capture in self._open.values():
+            if capture[0] == tag:
+                capture[1] += 1
+        element_id = dict(attrs).get('id')
+        if element_id in self.texts and self.texts[element_id] is None and element_id not in self._open:
+            if tag in _VOID_TAGS:
+                self.texts[element_id] = ''
+            else:
+                self._open[element_id] = [tag, 1, []]
+
+    def handle_endtag(self, tag):
+        for element_id, capture in list(self._open.items()):
+            if capture[0] == tag:
+                capture[1] -= 1
+                if capture[1] == 0:
+                    self._finish(element_id)
+
+    def handle_data(self, data):
+        for capture in self._open.values():
+            capture[2].append(data)
+
+    def _finish(self, element_id):
+        # Same text as BeautifulSoup's get_text(strip=True)
+        pieces = self._open.pop(element_id)[2]
+        self.texts[element_id] = "".join(p.strip() for p in pieces if p.strip())
+
+    def close(self):
+        super().close()
+        for element_id in list(self._open):
+            self._finish(element_id)
+
+
+def _parse_stream(response):
+    """Feed the response body to the parser until both elements are found."""
+    parser = _EventPageParser()
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for chunk in response.iter_content(_CHUNK_SIZE):
+        parser.feed(decoder.decode(chunk))
+        if parser.done:
+            break
+    else:
+        parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    details = parser.texts[DETAILS_ID]
+    return {
+        'title': parser.texts[TITLE_ID],
+        'details': details.replace(';', ' ') if details is not None else None,
+    }
+
+
+def _cache_path(cache_dir, url):
+    return os.path.join(cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+
+def _read_cached(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cached(path, entry):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def fetch_event_info(url, cache_dir=None, timeout=TIMEOUT):
+    """Fetch an HKIE event page and return {'title': ..., 'details': ...}.
+    A value is None when its element is missing from the page; network
+    errors propagate from requests.
+
+    The result is cached in cache_dir (default: the per-user cache) with
+    the page's validators and revalidated with a conditional request.
+    """
+    path = _cache_path(cache_dir or default_cache_dir('events'), url)
+    cached = _read_cached(path)
+    headers = {}
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    with get_session().get(url, headers=headers, timeout=timeout, stream=True) as response:
+        if response.status_code == 304 and cached:
+            return dict(cached['info'])
+        response.raise_for_status()
+        info = _parse_stream(response)
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+
+    if etag or last_modified:
+        _write_cached(path, {'url': url, 'etag': etag, 'last_modified': last_modified, 'info': info})
+    return info
+
+
+def fetch_events(events, workers=FETCH_WORKERS, cache_dir=None, timeout=TIMEOUT):
+    """Fetch several events concurrently; events are EventIDs or URLs.
+
+    Returns one dict per event, in order, with 'url', 'title', 'details'
+    and 'error' (None, or why the page could not be fetched).
+    """
+    urls = [event_url(event) for event in events]
+
+    def fetch(url):
+        try:
+            info = fetch_event_info(url, cache_dir=cache_dir, timeout=timeout)
+        except requests.RequestException as e:
+            return {'url': url, 'title': None, 'details': None, 'error': str(e)}
+        return dict(info, url=url, error=None)
+
+    if not urls:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(urls)))) as executor:
+        return list(executor.map(fetch, urls))
+
+
+def parse_event_list(text):
+    """EventIDs / URLs from free text: one per line, or separated by commas
+    or spaces."""
+    return [item for item in re.split(r'[\s,]+', text) if item]
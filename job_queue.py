@@ -0,0 +1,393 @@
+"""Local background queue for certificate generation.
+
+Each submitted job gets a directory holding its inputs, a status.json
+with its progress and, once finished, the certificates ZIP:
+
+    jobs = JobQueue()
+    job_id = jobs.submit("Event 600", df_final, template_bytes,
+                         event_title=..., event_details=..., to_pdf=True)
+    jobs.status(job_id)     # {'state': 'running', 'done': 120, 'total': 800, ...}
+    jobs.zip_path(job_id)   # once state is 'done'
+
+At most max_running jobs run at the same time, each in its own Python
+process started on this file (generate_certificates keeps per-process
+worker state, and a job must not block or crash the Streamlit server; a
+multiprocessing child would re-run the Streamlit script as __main__).
+Jobs that need Word run one at a time, as they would all drive the same
+Word.Application. No broker is involved: the queue lives in the calling
+process, and jobs still queued or running when that process stopped are
+queued again the next time a JobQueue is opened on the same directory.
+
+Cancelling (and closing the queue) is cooperative: a marker file in the
+job directory makes the job process stop at its next result, so its
+worker pool and PDF converters shut down cleanly. Only a job that has not
+stopped after STOP_GRACE seconds is killed, with its whole process group.
+"""
+import atexit
+import json
+import os
+import pickle
+import queue
+import secrets
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from cert_cache import CertificateCache, default_cache_dir
+from pipeline import write_batch_zip, write_certificates_zip
+from run_report import RunReport
+
+MAX_RUNNING = 2
+# Finished jobs (and their ZIPs) are deleted after this many seconds
+KEEP_SECONDS = 7 * 24 * 3600
+# Minimum seconds between two progress writes of a running job
+PROGRESS_INTERVAL = 0.5
+# Seconds a cancelled or stopped job gets to finish its batches in flight
+# before its process group is killed
+STOP_GRACE = 30
+
+INPUT_FILE = 'input.pkl'
+STATUS_FILE = 'status.json'
+ZIP_FILE = 'certs_output.zip'
+# Markers checked by the job process: cancelled by the user, or stopped by
+# close() (the job is then queued again by the next JobQueue)
+CANCEL_FILE = 'cancel'
+STOP_FILE = 'stop'
+ACTIVE_STATES = ('queued', 'running')
+
+# Options passed through to write_certificates_zip() / write_batch_zip() ('events')
+GENERATE_OPTIONS = ('event_title', 'event_details', 'events', 'to_pdf', 'backend', 'template_once', 'workers')
+
+
+def _write_json(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def uses_word(options):
+    """Whether a job may convert with Word (backend 'word', or 'auto' on Windows)."""
+    backend = options.get('backend', 'auto')
+    return bool(options.get('to_pdf')) and (backend == 'word' or (backend == 'auto' and os.name == 'nt'))
+
+
+def _touch(path):
+    with open(path, 'w'):
+        pass
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _kill_group(process):
+    """Kill a job process started in its own group, with its pool workers."""
+    if os.name == 'nt':
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], capture_output=True)
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    process.wait()
+
+
+class _Stopped(Exception):
+    """Raised in a job process when its cancel or stop marker appears."""
+
+
+class _Progress:
+    """on_result callback of a running job: keeps status.json up to date
+    and stops the job once it is cancelled."""
+
+    def __init__(self, job_dir, status):
+        self.path = os.path.join(job_dir, STATUS_FILE)
+        self.markers = [os.path.join(job_dir, name) for name in (CANCEL_FILE, STOP_FILE)]
+        self.status = status
+        self.written = 0.0
+
+    def __call__(self, res, total):
+        # Raising here closes the results: the pool and converters shut down
+        if any(os.path.exists(marker) for marker in self.markers):
+            raise _Stopped()
+        status = self.status
+        status['done'] = res['index'] + 1
+        status['total'] = total
+        status['current'] = res['name']
+        if res['error']:
+            status['errors'].append([res['name'], res['error']])
+        elif res['warning']:
+            status['warnings'].append([res['name'], res['warning']])
+        if time.time() - self.written >= PROGRESS_INTERVAL or status['done'] == total:
+            self.write()
+
+    def write(self):
+        try:
+            _write_json(self.path, self.status)
+        except OSError:
+            # Readers may hold the file open on Windows; the next write catches up
+            return
+        self.written = time.time()
+
+
+def _run_job(job_dir):
+    """Body of a job process: generate the ZIP and record the outcome."""
+    with open(os.path.join(job_dir, INPUT_FILE), 'rb') as f:
+        job = pickle.load(f)
+    status_path = os.path.join(job_dir, STATUS_FILE)
+    status = _read_json(status_path)
+    status.update(done=0, current=None, errors=[], warnings=[])
+    progress = _Progress(job_dir, status)
+
+    # Carry over the stages timed before the job was submitted (parse, match, ...)
+    report = RunReport()
+    for name, entry in job['stages'].items():
+        report.add(name, entry['seconds'], entry['count'])
+    cache = CertificateCache(job['cache_dir']) if job['cache_dir'] else None
+
+    zip_path = os.path.join(job_dir, ZIP_FILE)
+    part_path = zip_path + '.part'
+    kwargs = dict(job['options'], df_final=job['df_final'], out=part_path,
+                  on_result=progress, report=report, cache=cache)
+    if isinstance(job['template'], bytes):
+        generate = write_certificates_zip
+        kwargs['template'] = job['template']
+    else:
+        generate = write_batch_zip
+        kwargs['templates'] = job['template']
+    try:
+        if job['profile']:
+            # cProfile only sees this process
+            summary = report.profiled(generate, **dict(kwargs, workers=1))
+        else:
+            summary = generate(**kwargs)
+    except _Stopped:
+        _remove(part_path)
+        if not os.path.exists(os.path.join(job_dir, CANCEL_FILE)):
+            # Stopped by close(): leave the job running for the next JobQueue
+            return
+        status.update(state='cancelled')
+    except Exception as e:
+        status.update(state='failed', error=str(e))
+        _remove(part_path)
+    else:
+        os.replace(part_path, zip_path)
+        status.update(state='done', summary=summary)
+    status['finished'] = time.time()
+    status['report'] = report.as_dict()
+    _write_json(status_path, status)
+
+
+class JobQueue:
+    """Runs generation jobs in the background, at most max_running at once."""
+
+    def __init__(self, directory=None, max_running=MAX_RUNNING, workers=None):
+        self.directory = directory or default_cache_dir('jobs')
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_running = max_running
+        # Share the CPUs between the jobs that run at the same time
+        self.workers = workers or max(1, (os.cpu_count() or 1) // max_running)
+        self._lock = threading.Lock()
+        self._word_lock = threading.Lock()
+        self._processes = {}    # job id -> running Popen
+        self._cancelled = set()
+        self._closing = False
+        self._pending = queue.Queue()
+        # Daemon threads, and running jobs are stopped at exit: stopping the
+        # server must not wait for a long batch (it is resumed on restart)
+        for n in range(max_running):
+            threading.Thread(target=self._run_pending, name=f"cert-job-{n}", daemon=True).start()
+        atexit.register(self.close)
+
+        self.purge()
+        for status in reversed(self.jobs()):
+            if status['state'] in ACTIVE_STATES:
+                # The process that ran this queue stopped before the job finished
+                self._update(status['id'], state='queued')
+                self._pending.put(status['id'])
+
+    def _dir(self, job_id):
+        return os.path.join(self.directory, job_id)
+
+    def _update(self, job_id, **fields):
+        path = os.path.join(self._dir(job_id), STATUS_FILE)
+        status = _read_json(path)
+        status.update(fields)
+        _write_json(path, status)
+        return status
+
+    def submit(self, label, df_final, template, stages=None, cache_dir=None, profile=False, **options):
+        """Queue a write_certificates_zip() run and return its job id.
+
+        template is the .docx as bytes, or a list of (name, bytes) pairs for
+        a write_batch_zip() run (with options['events']). options are
+        keyword arguments of those functions (see GENERATE_OPTIONS);
+        stages are RunReport stages timed before the job (e.g. parse and
+        match) to include in its report. With cache_dir the job uses a
+        CertificateCache there; with profile it runs in-process under
+        cProfile.
+        """
+        unknown = set(options) - set(GENERATE_OPTIONS)
+        if unknown:
+            raise TypeError(f"unknown job options {sorted(unknown)}")
+        options.setdefault('workers', self.workers)
+
+        total = len(df_final)
+        if not isinstance(template, bytes):
+            total *= len(template) * len(options.get('events') or [None])
+
+        job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}"
+        job_dir = self._dir(job_id)
+        os.makedirs(job_dir)
+        with open(os.path.join(job_dir, INPUT_FILE), 'wb') as f:
+            pickle.dump({
+                'df_final': df_final, 'template': template, 'options': options,
+                'stages': stages or {}, 'cache_dir': cache_dir, 'profile': profile,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        _write_json(os.path.join(job_dir, STATUS_FILE), {
+            'id': job_id, 'label': label, 'state': 'queued', 'word': uses_word(options),
+            'submitted': time.time(), 'started': None, 'finished': None,
+            'done': 0, 'total': total, 'current': None, 'errors': [], 'warnings': [],
+            'error': None, 'summary': None, 'report': None,
+        })
+        self._pending.put(job_id)
+        return job_id
+
+    def _run_pending(self):
+        while True:
+            job_id = self._pending.get()
+            try:
+                self._execute(job_id)
+            except Exception as e:
+                with self._lock:
+                    self._update(job_id, state='failed', finished=time.time(), error=str(e))
+
+    def _execute(self, job_id):
+        status = self.status(job_id)
+        if status is None or status['state'] != 'queued':
+            return
+        # Word jobs wait for each other, other jobs do not wait for them
+        word_lock = self._word_lock if status['word'] else None
+        if word_lock:
+            word_lock.acquire()
+        try:
+            with self._lock:
+                # Cancelled while waiting, or the server is stopping
+                if self._closing or self.status(job_id)['state'] != 'queued':
+                    return
+                self._update(job_id, state='running', started=time.time())
+                # A stop marker left by the close() that interrupted the job
+                _remove(os.path.join(self._dir(job_id), STOP_FILE))
+                # Own process group, so that a job that ignores its marker
+                # can be killed together with its pool workers
+                if os.name == 'nt':
+                    group = dict(creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+                else:
+                    group = dict(start_new_session=True)
+                process = subprocess.Popen([sys.executable, os.path.abspath(__file__), self._dir(job_id)],
+                                           **group)
+                self._processes[job_id] = process
+            process.wait()
+            with self._lock:
+                self._processes.pop(job_id, None)
+                if self._closing:
+                    return
+                if job_id in self._cancelled:
+                    # A progress write may have landed after cancel(); a
+                    # killed job leaves its partial ZIP behind
+                    self._update(job_id, state='cancelled')
+                    _remove(os.path.join(self._dir(job_id), ZIP_FILE + '.part'))
+                elif self.status(job_id)['state'] == 'running':
+                    # The job process died without recording an outcome
+                    self._update(job_id, state='failed', finished=time.time(),
+                                 error=f"job process exited with code {process.returncode}")
+        finally:
+            if word_lock:
+                word_lock.release()
+
+    def status(self, job_id):
+        """status.json of a job as a dict, or None for an unknown job."""
+        return _read_json(os.path.join(self._dir(job_id), STATUS_FILE))
+
+    def jobs(self):
+        """Status of every job, most recently submitted first."""
+        statuses = []
+        for name in os.listdir(self.directory):
+            status = self.status(name)
+            if status:
+                statuses.append(status)
+        return sorted(statuses, key=lambda s: s['submitted'], reverse=True)
+
+    def zip_path(self, job_id):
+        """Path of the finished certificates ZIP, or None."""
+        path = os.path.join(self._dir(job_id), ZIP_FILE)
+        return path if os.path.exists(path) else None
+
+    def cancel(self, job_id):
+        """Stop a queued or running job; returns whether it was active.
+        A running job stops at its next result, or is killed after
+        STOP_GRACE seconds."""
+        with self._lock:
+            status = self.status(job_id)
+            if status is None or status['state'] not in ACTIVE_STATES:
+                return False
+            self._cancelled.add(job_id)
+            _touch(os.path.join(self._dir(job_id), CANCEL_FILE))
+            self._update(job_id, state='cancelled', finished=time.time())
+            process = self._processes.get(job_id)
+        if process is not None:
+            threading.Thread(target=self._reap, args=(process,), daemon=True).start()
+        return True
+
+    @staticmethod
+    def _reap(process, timeout=None):
+        try:
+            process.wait(STOP_GRACE if timeout is None else timeout)
+        except subprocess.TimeoutExpired:
+            _kill_group(process)
+
+    def close(self):
+        """Stop the running jobs, leaving them to be resumed by the next
+        JobQueue on this directory."""
+        with self._lock:
+            self._closing = True
+            running = list(self._processes.items())
+        for job_id, process in running:
+            _touch(os.path.join(self._dir(job_id), STOP_FILE))
+        deadline = time.time() + STOP_GRACE
+        for _, process in running:
+            self._reap(process, max(0.0, deadline - time.time()))
+
+    def remove(self, job_id):
+        """Delete a job that is not active, with its ZIP."""
+        status = self.status(job_id)
+        if status is not None and status['state'] in ACTIVE_STATES:
+            raise ValueError(f"job {job_id} is still {status['state']}")
+        shutil.rmtree(self._dir(job_id), ignore_errors=True)
+
+    def purge(self, max_age=KEEP_SECONDS):
+        """Delete finished jobs older than max_age seconds."""
+        now = time.time()
+        for status in self.jobs():
+            if status['state'] not in ACTIVE_STATES and now - (status['finished'] or status['submitted']) > max_age:
+                shutil.rmtree(self._dir(status['id']), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    _run_job(sys.argv[1])
@@ -0,0 +1,184 @@
+"""DOCX -> PDF converter backends.
+
+Every backend converts a batch of .docx files at a time and reports a
+result per file, so failures are surfaced instead of being swallowed:
+
+- "word": Microsoft Word through COM (Windows only)
+- "libreoffice": headless soffice, any platform
+
+get_converter("auto") picks Word when it is available and LibreOffice
+otherwise.
+"""
+import glob
+import os
+import shutil
+import subprocess
+import tempfile
+
+BACKENDS = ('auto', 'word', 'libreoffice')
+
+
+class ConversionError(Exception):
+    """Raised when a converter backend cannot be started."""
+
+
+class PdfConverter:
+    """Base class: convert(docx_paths, out_dir) -> [(pdf_path, error)]."""
+
+    name = ''
+
+    def convert(self, docx_paths, out_dir):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class WordConverter(PdfConverter):
+    """One long-lived Word.Application instance, reused for every file."""
+
+    name = 'word'
+
+    def __init__(self):
+        try:
+            import pythoncom
+            import win32com.client
+        except ImportError as e:
+            raise ConversionError(f"Word backend needs pywin32: {e}")
+        self._pythoncom = pythoncom
+        try:
+            pythoncom.CoInitialize()
+            self.word = win32com.client.DispatchEx("Word.Application")
+            self.word.Visible = False
+            self.word.DisplayAlerts = False
+        except Exception as e:
+            raise ConversionError(f"Cannot start Word: {e}")
+
+    def convert(self, docx_paths, out_dir):
+        results = []
+        for docx_path in docx_paths:
+            stem = os.path.splitext(os.path.basename(docx_path))[0]
+            pdf_path = os.path.join(out_dir, f"{stem}.pdf")
+            try:
+                wb_doc = self.word.Documents.Open(os.path.abspath(docx_path))
+                wb_doc.SaveAs(os.path.abspath(pdf_path), FileFormat=17)
+                wb_doc.Close(SaveChanges=False)
+                results.append((pdf_path, None))
+            except Exception as e:
+                results.append((None, str(e)))
+        return results
+
+    def close(self):
+        if self.word:
+            try:
+                self.word.Quit()
+            except Exception:
+                pass
+            self.word = None
+            self._pythoncom.CoUninitialize()
+
+
+def find_soffice():
+    """Return the path of the LibreOffice binary, or None."""
+    for name in ('soffice', 'libreoffice'):
+        path = shutil.which(name)
+        if path:
+            return path
+    candidates = [
+        r"C:\Program Files\LibreOffice\program\soffice.exe",
+        "/Applications/LibreOffice.app/Contents/MacOS/soffice",
+        "/usr/lib/libreoffice/program/soffice",
+        "/opt/libreoffice*/program/soffice",
+    ]
+    for pattern in candidates:
+        for path in glob.glob(pattern):
+            if os.access(path, os.X_OK):
+                return path
+    return None
+
+
+class LibreOfficeConverter(PdfConverter):
+    """Headless soffice with its own persistent user profile.
+
+    soffice refuses to run two instances on one profile, so each converter
+    (one per generation worker) owns a profile directory that is created
+    on first use and kept warm for every later batch. A whole batch of
+    files is converted by a single soffice invocation.
+    """
+
+    name = 'libreoffice'
+
+    def __init__(self, soffice=None, timeout=600):
+        self.soffice = soffice or find_soffice()
+        if not self.soffice:
+            raise ConversionError("LibreOffice (soffice) not found")
+        self.timeout = timeout
+        self._profile = tempfile.mkdtemp(prefix='cpd_soffice_')
+
+    def _command(self, docx_paths, out_dir):
+        profile_url = 'file:///' + os.path.abspath(self._profile).replace('\\', '/').lstrip('/')
+        return [
+            self.soffice,
+            f'-env:UserInstallation={profile_url}',
+            '--headless', '--norestore', '--nologo', '--nodefault', '--nolockcheck',
+            '--convert-to', 'pdf', '--outdir', os.path.abspath(out_dir),
+        ] + [os.path.abspath(p) for p in docx_paths]
+
+    def convert(self, docx_paths, out_dir):
+        if not docx_paths:
+            return []
+        error = None
+        try:
+            proc = subprocess.run(
+                self._command(docx_paths, out_dir),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                timeout=self.timeout,
+            )
+            if proc.returncode != 0:
+                error = proc.stderr.decode('utf-8', errors='ignore').strip() or f"soffice exited with {proc.returncode}"
+        except (OSError, subprocess.TimeoutExpired) as e:
+            error = str(e)
+
+        results = []
+        for docx_path in docx_paths:
+            stem = os.path.splitext(os.path.basename(docx_path))[0]
+            pdf_path = os.path.join(out_dir, f"{stem}.pdf")
+            if os.path.exists(pdf_path):
+                results.append((pdf_path, None))
+            else:
+                results.append((None, error or "soffice produced no PDF"))
+        return results
+
+    def close(self):
+        shutil.rmtree(self._profile, ignore_errors=True)
+
+
+def get_converter(backend='auto'):
+    """Create a converter for backend ("auto", "word" or "libreoffice").
+
+    Raises ConversionError when the requested backend is unavailable.
+    """
+    if backend not in BACKENDS:
+        raise ConversionError(f"Unknown PDF backend: {backend}")
+    if backend == 'word':
+        return WordConverter()
+    if backend == 'libreoffice':
+        return LibreOfficeConverter()
+
+    errors = []
+    if os.name == 'nt':
+        try:
+            return WordConverter()
+        except ConversionError as e:
+            errors.append(str(e))
+    try:
+        return LibreOfficeConverter()
+    except ConversionError as e:
+        errors.append(str(e))
+    raise ConversionError("No PDF converter available: " + "; ".join(errors))
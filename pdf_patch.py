@@ -0,0 +1,527 @@
+"""Template-once PDF output.
+
+Every certificate has the same layout; only a few strings (the attendee's
+name and membership number) change. Instead of converting one document
+per attendee, build_base_pdf() converts a single base certificate in which
+each per-attendee field holds a marker, and BasePdf.render() writes each
+attendee's PDF by replacing the markers' text in the page content stream
+and encrypting the result in memory.
+
+Two details make the patched text look like a converted one:
+
+- The base document gets an extra "glyph sheet" page, in the formatting of
+  each field, listing every character the attendees' values use. The PDF
+  font subset therefore contains all of them; the page is dropped again.
+- A second copy with longer markers, holding each field's longest value,
+  is converted alongside; comparing the two shows whether the field is
+  left-, centre- or right-aligned, so the patched text is positioned the
+  way Word / LibreOffice would place it, and how wide a value may be
+  without being wrapped.
+
+Only what can be patched exactly is patched. PatchError is raised when a
+marker is not drawn by a single text operator, shares its printed line
+with other text (allowed only after it on a left-aligned line), or its
+font has no Unicode map, and (in render) when a character is missing from
+the font subset or a value is wider than the long marker, i.e. might wrap;
+the caller then converts that certificate normally.
+"""
+import io
+import os
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+import pikepdf
+
+_MARKER = 'QZJX{}XJZQ'
+_LONG_PAD = 'W' * 8
+_MARKER_RE = re.compile(r'QZJX([A-Z])(?:W{8}.*?)?XJZQ')
+_SHEET_SENTINEL = 'QZJXGLYPHSXJZQ'
+_DOCUMENT = 'word/document.xml'
+_IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+# Alignment ratios: how far the start of a line moves per unit of extra width
+_ALIGNMENTS = (0.0, 0.5, 1.0)
+# Text ops whose baselines are closer than this fraction of the marker's
+# font size are on the same printed line
+_BASELINE_TOLERANCE = 0.5
+
+
+class PatchError(Exception):
+    """Raised when a certificate cannot be produced by patching the base PDF."""
+
+
+def _marker(i, longest=None):
+    letter = chr(ord('A') + i)
+    return _MARKER.format(letter if longest is None else letter + _LONG_PAD + longest)
+
+
+def variable_fields(contexts):
+    """Context keys whose value differs between attendees."""
+    first = contexts[0]
+    return [key for key in first if any(ctx[key] != first[key] for ctx in contexts[1:])]
+
+
+# --- Base document ---
+
+def _enclosing(xml, pos, tag):
+    """(start, end) of the innermost <tag ...>...</tag> element around pos."""
+    start = max(xml.rfind(f'<{tag}>', 0, pos), xml.rfind(f'<{tag} ', 0, pos))
+    end = xml.find(f'</{tag}>', pos)
+    if start < 0 or end < 0:
+        return None
+    return start, end + len(f'</{tag}>')
+
+
+def add_glyph_sheet(docx_bytes, charsets):
+    """Append a page that shows charsets[marker] in the paragraph and run
+    formatting of that marker, so its font subset covers every character."""
+    with zipfile.ZipFile(io.BytesIO(docx_bytes)) as zin:
+        members = [(info, zin.read(info.filename)) for info in zin.infolist()]
+    parts = dict((info.filename, data) for info, data in members)
+    if _DOCUMENT not in parts:
+        raise PatchError('no document part')
+    xml = parts[_DOCUMENT].decode('utf-8')
+
+    sheet = ['<w:p><w:r><w:br w:type="page"/></w:r></w:p>']
+    for marker, chars in charsets.items():
+        pos = xml.find(marker)
+        if pos < 0:
+            continue
+        para = _enclosing(xml, pos, 'w:p')
+        run = _enclosing(xml, pos, 'w:r')
+        if not para or not run:
+            continue
+        ppr = re.search(r'<w:pPr>.*?</w:pPr>', xml[para[0]:para[1]], re.S)
+        rpr = re.search(r'<w:rPr>.*?</w:rPr>', xml[run[0]:run[1]], re.S)
+        # A copied section break would start a new section with other page settings
+        ppr = re.sub(r'<w:sectPr\b.*?</w:sectPr>', '', ppr.group(0), flags=re.S) if ppr else ''
+        rpr = rpr.group(0) if rpr else ''
+        text = escape(_SHEET_SENTINEL + ' ' + ''.join(sorted(chars)))
+        sheet.append(f'<w:p>{ppr}<w:r>{rpr}<w:t xml:space="preserve">{text}</w:t></w:r></w:p>')
+
+    body_end = xml.rfind('<w:sectPr')
+    if body_end < 0 or body_end < xml.rfind('</w:p>'):
+        body_end = xml.rfind('</w:body>')
+    xml = xml[:body_end] + ''.join(sheet) + xml[body_end:]
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zout:
+        for info, data in members:
+            zout.writestr(info, xml.encode('utf-8') if info.filename == _DOCUMENT else data)
+    return buf.getvalue()
+
+
+def build_base_pdf(template, contexts, converter, scratch):
+    """Convert the base certificate for contexts (one per attendee) with
+    converter and return a BasePdf. template is a CompiledTemplate;
+    scratch is a directory for the intermediate files."""
+    fields = variable_fields(contexts)
+    if len(fields) > 26:
+        raise PatchError('too many per-attendee fields')
+    base = dict(contexts[0])
+    long = dict(contexts[0])
+    charsets = {}
+    for i, key in enumerate(fields):
+        base[key] = _marker(i)
+        long[key] = _marker(i, longest=max((str(ctx[key]) for ctx in contexts), key=len))
+        charsets[_marker(i)] = set(''.join(str(ctx[key]) for ctx in contexts)) | {' '}
+
+    base_docx = template.render(base)
+    expected = _marker_counts(base_docx, fields)
+    paths = [os.path.join(scratch, 'base.docx'), os.path.join(scratch, 'base_long.docx')]
+    with open(paths[0], 'wb') as f:
+        f.write(add_glyph_sheet(base_docx, charsets))
+    with open(paths[1], 'wb') as f:
+        f.write(template.render(long))
+
+    pdfs = []
+    for (pdf_path, error) in converter.convert(paths, scratch):
+        if error:
+            raise PatchError(f"{converter.name}: {error}")
+        with open(pdf_path, 'rb') as f:
+            pdfs.append(f.read())
+        os.remove(pdf_path)
+    for path in paths:
+        os.remove(path)
+    return BasePdf(pdfs[0], pdfs[1], fields, expected, backend=converter.name)
+
+
+def _marker_counts(docx_bytes, fields):
+    """How many times each field's marker occurs in the document parts."""
+    counts = dict.fromkeys(fields, 0)
+    with zipfile.ZipFile(io.BytesIO(docx_bytes)) as zin:
+        for name in zin.namelist():
+            if name.endswith('.xml'):
+                xml = zin.read(name).decode('utf-8', errors='ignore')
+                for i, key in enumerate(fields):
+                    counts[key] += xml.count(_marker(i))
+    return counts
+
+
+# --- Fonts ---
+
+def _parse_cmap(data):
+    """Code bytes -> text from a ToUnicode CMap."""
+    mapping = {}
+
+    def utf16(hex_str):
+        return bytes.fromhex(hex_str).decode('utf-16-be', errors='ignore')
+
+    for block in re.findall(rb'beginbfchar(.*?)endbfchar', data, re.S):
+        for src, dst in re.findall(rb'<([0-9A-Fa-f]+)>\s*<([0-9A-Fa-f]*)>', block):
+            mapping[bytes.fromhex(src.decode())] = utf16(dst.decode())
+    for block in re.findall(rb'beginbfrange(.*?)endbfrange', data, re.S):
+        for lo, hi, dst in re.findall(rb'<([0-9A-Fa-f]+)>\s*<([0-9A-Fa-f]+)>\s*(<[0-9A-Fa-f]*>|\[[^\]]*\])', block):
+            size = len(lo) // 2
+            lo, hi = int(lo, 16), int(hi, 16)
+            if dst.startswith(b'['):
+                targets = [utf16(t.decode()) for t in re.findall(rb'<([0-9A-Fa-f]*)>', dst)]
+                for offset, text in enumerate(targets[:hi - lo + 1]):
+                    mapping[(lo + offset).to_bytes(size, 'big')] = text
+            else:
+                start = bytes.fromhex(dst[1:-1].decode())
+                for offset in range(hi - lo + 1):
+                    if not start or start[-1] + offset > 255:
+                        break
+                    text = start[:-1] + bytes([start[-1] + offset])
+                    mapping[(lo + offset).to_bytes(size, 'big')] = text.decode('utf-16-be', errors='ignore')
+    return mapping
+
+
+class _Font:
+    """What is needed to read and write text in one PDF font: code length,
+    code -> text, text -> code and glyph widths (1/1000 text space)."""
+
+    def __init__(self, font):
+        subtype = str(font.get('/Subtype', ''))
+        self.composite = subtype == '/Type0'
+        self.code_len = 2 if self.composite else 1
+        self.widths = {}
+        self.default_width = 0
+
+        if self.composite:
+            if str(font.get('/Encoding', '')) not in ('/Identity-H', '/Identity-V'):
+                raise PatchError('unsupported composite font encoding')
+            descendant = font.DescendantFonts[0]
+            self.default_width = float(descendant.get('/DW', 1000))
+            w = list(descendant.get('/W', []))
+            i = 0
+            while i < len(w):
+                first = int(w[i])
+                if isinstance(w[i + 1], pikepdf.Array):
+                    for offset, width in enumerate(w[i + 1]):
+                        self.widths[first + offset] = float(width)
+                    i += 2
+                else:
+                    for code in range(first, int(w[i + 1]) + 1):
+                        self.widths[code] = float(w[i + 2])
+                    i += 3
+        else:
+            first = int(font.get('/FirstChar', 0))
+            for offset, width in enumerate(font.get('/Widths', [])):
+                self.widths[first + offset] = float(width)
+            descriptor = font.get('/FontDescriptor')
+            if descriptor is not None:
+                self.default_width = float(descriptor.get('/MissingWidth', 0))
+
+        if '/ToUnicode' in font:
+            self.to_text = _parse_cmap(font.ToUnicode.read_bytes())
+        elif not self.composite and str(font.get('/Encoding', '')) == '/WinAnsiEncoding':
+            self.to_text = {bytes([c]): bytes([c]).decode('cp1252', errors='ignore') for c in range(32, 256)}
+        else:
+            raise PatchError('font has no Unicode mapping')
+        self.to_code = {}
+        for code, text in sorted(self.to_text.items()):
+            if len(text) == 1:
+                self.to_code.setdefault(text, code)
+
+    def codes(self, raw):
+        raw = bytes(raw)
+        return [raw[i:i + self.code_len] for i in range(0, len(raw), self.code_len)]
+
+    def glyph_width(self, code):
+        return self.widths.get(int.from_bytes(code, 'big'), self.default_width)
+
+    def advance(self, items, state):
+        """Width in text space of TJ-style items (strings and kerning numbers)."""
+        size, tc, tw, th = state['size'], state['Tc'], state['Tw'], state['Tz'] / 100.0
+        width = 0.0
+        for item in items:
+            if not isinstance(item, (bytes, pikepdf.String)):
+                width -= float(item) / 1000.0 * size * th
+                continue
+            for code in self.codes(item):
+                space = tw if code == b' ' else 0.0
+                width += (self.glyph_width(code) / 1000.0 * size + tc + space) * th
+        return width
+
+    def decode(self, items):
+        return ''.join(self.to_text.get(code, '�')
+                       for item in items if isinstance(item, (bytes, pikepdf.String))
+                       for code in self.codes(item))
+
+    def encode(self, text):
+        """TJ items for text; a missing space becomes a kerning gap."""
+        items, current = [], b''
+        for ch in text:
+            code = self.to_code.get(ch)
+            if code is None:
+                if ch != ' ':
+                    raise PatchError(f"character {ch!r} is not in the font subset")
+                items += [current, -250.0]
+                current = b''
+            else:
+                current += code
+        items.append(current)
+        return [item for item in items if item != b'']
+
+
+# --- Content streams ---
+
+def _mul(m, n):
+    a, b, c, d, e, f = m
+    a2, b2, c2, d2, e2, f2 = n
+    return (a * a2 + b * c2, a * b2 + b * d2, c * a2 + d * c2, c * b2 + d * d2,
+            e * a2 + f * c2 + e2, e * b2 + f * d2 + f2)
+
+
+def _translate(tx, ty):
+    return (1.0, 0.0, 0.0, 1.0, tx, ty)
+
+
+def _scan(pdf, page):
+    """Parse page's content stream and return (instructions, text ops).
+
+    Each text op records where it starts (text matrix, line matrix after
+    any implicit line move), the text state, its decoded text and width,
+    and its start on the page ('x', 'y': the text origin in user space, so
+    'y' is its baseline).
+    """
+    instructions = list(pikepdf.parse_content_stream(page))
+    resources = page.obj.get('/Resources', {})
+    font_dicts = resources.get('/Font', {}) if resources else {}
+    fonts = {}
+
+    def font_for(name):
+        if name not in fonts:
+            try:
+                fonts[name] = _Font(font_dicts[name]) if name in font_dicts else None
+            except PatchError:
+                fonts[name] = None
+        return fonts[name]
+
+    state = {'Tc': 0.0, 'Tw': 0.0, 'Tz': 100.0, 'TL': 0.0, 'font': None, 'size': 0.0}
+    stack = []
+    ctm = tm = tlm = _IDENTITY
+    texts = []
+    for index, (operands, operator) in enumerate(instructions):
+        op = str(operator)
+        if op == 'q':
+            stack.append((dict(state), ctm))
+        elif op == 'Q':
+            if stack:
+                state, ctm = stack.pop()
+        elif op == 'cm':
+            ctm = _mul(tuple(float(x) for x in operands), ctm)
+        elif op == 'BT':
+            tm = tlm = _IDENTITY
+        elif op in ('Tc', 'Tw', 'Tz', 'TL'):
+            state[op] = float(operands[0])
+        elif op == 'Tf':
+            state['font'] = font_for(str(operands[0]))
+            state['font_name'] = str(operands[0])
+            state['size'] = float(operands[1])
+        elif op == 'Tm':
+            tm = tlm = tuple(float(x) for x in operands)
+        elif op in ('Td', 'TD'):
+            tx, ty = float(operands[0]), float(operands[1])
+            if op == 'TD':
+                state['TL'] = -ty
+            tm = tlm = _mul(_translate(tx, ty), tlm)
+        elif op == 'T*':
+            tm = tlm = _mul(_translate(0.0, -state['TL']), tlm)
+        elif op in ('Tj', 'TJ', "'", '"'):
+            if op in ("'", '"'):
+                if op == '"':
+                    state['Tw'], state['Tc'] = float(operands[0]), float(operands[1])
+                tm = tlm = _mul(_translate(0.0, -state['TL']), tlm)
+            items = list(operands[0]) if op == 'TJ' else [operands[-1]]
+            font = state['font']
+            width = font.advance(items, state) if font else 0.0
+            origin = _mul(tm, ctm)
+            texts.append({
+                'index': index, 'op': op, 'operands': list(operands),
+                'x': origin[4], 'y': origin[5], 'scale': abs(origin[3]) or abs(origin[2]),
+                'tm': tm, 'tlm': tlm, 'state': dict(state),
+                'text': font.decode(items) if font else '',
+                'old_width': width,
+            })
+            tm = _mul(_translate(width, 0.0), tm)
+    return instructions, texts
+
+
+def _find_markers(texts):
+    """[(field letter, text op, match, text before)] for every marker, in
+    stream order. Raises PatchError if other text follows the marker on its
+    printed line; text before is whether other text precedes it, which
+    only a left-aligned field allows."""
+    found = []
+    for text in texts:
+        for m in _MARKER_RE.finditer(text['text']):
+            if text['state']['font'] is None:
+                raise PatchError('field font cannot be read')
+            # Converters often draw every run of a line in its own BT ... ET
+            # block, so the line is found by baseline, not by text object
+            tolerance = _BASELINE_TOLERANCE * text['state']['size'] * text['scale']
+            same_line = [t for t in texts if t is not text and t['text'].strip()
+                         and abs(t['y'] - text['y']) <= tolerance]
+            if any(t['x'] >= text['x'] for t in same_line):
+                raise PatchError('text follows a field on the same line')
+            found.append((m.group(1), text, m, bool(same_line)))
+    return found
+
+
+def _num(x):
+    return f"{x:.4f}".rstrip('0').rstrip('.') or '0'
+
+
+class _Field:
+    """One marker occurrence: everything needed to draw a value in its place."""
+
+    def __init__(self, field, text, match, alignment, max_width):
+        self.field = field
+        self.prefix = text['text'][:match.start()]
+        self.suffix = text['text'][match.end():]
+        self.state = text['state']
+        self.font = text['state']['font']
+        self.op = text['op']
+        # Word / char spacing set by a '"' operator (plain floats: picklable)
+        self.spacing = tuple(float(x) for x in text['operands'][:2]) if self.op == '"' else None
+        self.tm = text['tm']
+        self.tlm = text['tlm']
+        self.old_width = text['old_width']
+        self.alignment = alignment
+        # Width of the line with the long marker, which the converter did not wrap
+        self.max_width = max_width
+
+    def render(self, value):
+        items = self.font.encode(self.prefix + value + self.suffix)
+        width = self.font.advance(items, self.state)
+        if width > self.max_width:
+            raise PatchError('value is wider than the field was measured')
+        dx = -self.alignment * (width - self.old_width)
+        a, b, c, d, e, f = self.tm
+        out = []
+        if self.spacing:
+            out.append(f"{_num(self.spacing[0])} Tw {_num(self.spacing[1])} Tc")
+        # Start where the converter would have started the longer / shorter
+        # line, then restore the line matrix for the operators that follow
+        out.append(' '.join(_num(x) for x in (a, b, c, d, e + dx * a, f + dx * b)) + ' Tm')
+        out.append('[' + ' '.join(f"<{item.hex()}>" if isinstance(item, bytes) else _num(item)
+                                  for item in items) + '] TJ')
+        out.append(' '.join(_num(x) for x in self.tlm) + ' Tm')
+        return ('\n'.join(out) + '\n').encode('ascii')
+
+
+class BasePdf:
+    """The converted base certificate, ready to be patched per attendee.
+
+    expected maps each field to the number of markers in the document; the
+    PDF must show exactly as many.
+
+    render(context, password) returns the attendee's encrypted PDF bytes or
+    raises PatchError. Instances are picklable, so the pool workers get a
+    copy through their initializer.
+    """
+
+    def __init__(self, pdf_bytes, long_pdf_bytes, fields, expected, backend=''):
+        self.fields = list(fields)
+        self.backend = backend
+        self._pages = []        # (page index, [static bytes], [_Field])
+
+        with pikepdf.open(io.BytesIO(pdf_bytes)) as pdf, pikepdf.open(io.BytesIO(long_pdf_bytes)) as long_pdf:
+            scans = [_scan(pdf, page) for page in pdf.pages]
+            sheet_start = next((i for i, (_, texts) in enumerate(scans)
+                                if _SHEET_SENTINEL in ''.join(t['text'] for t in texts)), None)
+            if sheet_start is None:
+                raise PatchError('glyph sheet not found in the base PDF')
+            if len(long_pdf.pages) < sheet_start:
+                raise PatchError('base documents differ in length')
+
+            for page_index in range(sheet_start):
+                instructions, texts = scans[page_index]
+                markers = _find_markers(texts)
+                if not markers:
+                    continue
+                long_markers = _find_markers(_scan(long_pdf, long_pdf.pages[page_index])[1])
+                if [m[0] for m in markers] != [m[0] for m in long_markers]:
+                    raise PatchError('base documents differ in layout')
+                fields = []
+                for (letter, text, match, preceded), (_, long_text, _, _) in zip(markers, long_markers):
+                    alignment = self._alignment(text, long_text)
+                    if preceded and alignment != 0.0:
+                        # Moving the field would also move the text before it
+                        raise PatchError('text precedes a centred or right-aligned field')
+                    fields.append(_Field(self._field_name(letter), text, match, alignment,
+                                         long_text['old_width']))
+                self._pages.append((page_index, self._split(instructions, [m[1]['index'] for m in markers]),
+                                    fields))
+
+            # A marker the PDF hides from us (unreadable font, drawn in a form
+            # XObject, split by the converter) would be printed as-is
+            found = dict.fromkeys(self.fields, 0)
+            for _, _, fields in self._pages:
+                for field in fields:
+                    found[field.field] += 1
+            if found != expected:
+                raise PatchError('not every field could be located in the base PDF')
+
+            del pdf.pages[sheet_start:]
+            buf = io.BytesIO()
+            pdf.save(buf)
+            self.pdf_bytes = buf.getvalue()
+
+    def _field_name(self, letter):
+        i = ord(letter) - ord('A')
+        if i >= len(self.fields):
+            raise PatchError('unknown marker in the base PDF')
+        return self.fields[i]
+
+    @staticmethod
+    def _alignment(text, long_text):
+        a, b, c, d = text['tm'][:4]
+        if abs(b) > 1e-6 or abs(c) > 1e-6 or a <= 0:
+            raise PatchError('rotated or mirrored text')
+        extra = (long_text['old_width'] - text['old_width']) * a
+        if extra <= 0:
+            raise PatchError('cannot measure the field alignment')
+        ratio = (text['tm'][4] - long_text['tm'][4]) / extra
+        for alignment in _ALIGNMENTS:
+            if abs(ratio - alignment) < 0.1:
+                return alignment
+        raise PatchError('field is neither left-, centre- nor right-aligned')
+
+    @staticmethod
+    def _split(instructions, indexes):
+        """Unparsed content stream pieces around the instructions at indexes."""
+        pieces, start = [], 0
+        if len(set(indexes)) != len(indexes):
+            raise PatchError('several fields in one text operator')
+        for index in indexes:
+            pieces.append(pikepdf.unparse_content_stream(instructions[start:index]) + b'\n')
+            start = index + 1
+        pieces.append(pikepdf.unparse_content_stream(instructions[start:]))
+        return pieces
+
+    def render(self, context, password):
+        """Patch context into the base PDF and return it encrypted with password."""
+        with pikepdf.open(io.BytesIO(self.pdf_bytes)) as pdf:
+            for page_index, statics, fields in self._pages:
+                parts = [statics[0]]
+                for field, static in zip(fields, statics[1:]):
+                    parts.append(field.render(str(context[field.field])))
+                    parts.append(static)
+                pdf.pages[page_index].Contents = pdf.make_stream(b''.join(parts))
+            buf = io.BytesIO()
+            pdf.save(buf, encryption=pikepdf.Encryption(owner=password, user=password, R=6))
+        return buf.getvalue()
@@ -0,0 +1,339 @@
+"""End-to-end certificate pipeline, usable without Streamlit.
+
+The Streamlit app and the command line tool (cli.py) both run the same
+steps from here:
+
+    fetch_event_info -> load_registration -> load_zoom -> match_registration
+    -> write_certificates_zip
+
+run_event() chains them for one event; call it repeatedly to process
+several events in one process, or use its batch mode (write_batch_zip)
+to certify one attendee list for several events and / or templates.
+"""
+import os
+import re
+import zipfile
+from contextlib import closing
+
+from attendance import (
+    NAME_MATCH_THRESHOLD, dedupe_zoom_attendees, match_attendance, normalize_emails, normalize_names,
+    parse_zoom_report, zoom_columns,
+)
+from cert_cache import template_digest
+from cert_engine import add_to_archive, build_jobs, cached_result, generate_certificates, prepare_base_pdf
+from cert_template import read_template_bytes
+from event_info import fetch_events
+from registration import load_registration, missing_required_columns
+from run_report import RunReport
+
+
+class PipelineError(Exception):
+    """Raised when an input cannot be used or the run has to be aborted."""
+
+
+def load_zoom(file_obj):
+    """Parse a Zoom report, merge re-joins and add the normalized columns.
+
+    Returns a dict with 'error', 'columns', 'raw_rows', 'user_col',
+    'email_col' and, when both columns were found, 'df'.
+    """
+    df_zoom, zoom_err = parse_zoom_report(file_obj)
+    if zoom_err:
+        return {'error': zoom_err}
+
+    info = {'error': None, 'columns': df_zoom.columns.tolist(), 'raw_rows': len(df_zoom)}
+    z_user_col, z_email_col, z_time_col = zoom_columns(df_zoom)
+    info['user_col'], info['email_col'] = z_user_col, z_email_col
+    if not z_user_col or not z_email_col:
+        return info
+
+    # Aggregate total time in session per attendee (handles re-joins)
+    df_zoom = dedupe_zoom_attendees(df_zoom, z_email_col, z_time_col)
+    df_zoom['Name_Norm'] = normalize_names(df_zoom[z_user_col])
+    df_zoom['Email_Norm'] = normalize_emails(df_zoom[z_email_col])
+    info['df'] = df_zoom
+    return info
+
+
+def match_registration(df_reg, zoom, match_names=False, name_threshold=NAME_MATCH_THRESHOLD):
+    """Match a mapped registration list against load_zoom() output.
+    With match_names, registrants whose email is not in the report are
+    also matched by name; those rows need a reviewer's confirmation.
+    Returns (df_final, df_unmatched)."""
+    df_reg = df_reg.copy()
+    df_reg['Name_Norm'] = normalize_names(df_reg['First Name'].astype(str) + " " + df_reg['Last Name'].astype(str))
+    df_reg['Email_Norm'] = normalize_emails(df_reg['Email'])
+    return match_attendance(
+        df_reg, zoom['df'], zoom['user_col'],
+        match_names=match_names, name_threshold=name_threshold,
+    )
+
+
+def registration_only(df_reg):
+    """Certificate list for every registrant (no Zoom verification)."""
+    df_final = df_reg.copy()
+    df_final['Full Name'] = df_final['First Name'].astype(str) + " " + df_final['Last Name'].astype(str)
+    df_final['Match Method'] = "Registration Only"
+    return df_final
+
+
+def write_certificates_zip(df_final, template, out, event_title, event_details,
+                           to_pdf=False, backend='auto', workers=None, on_result=None, report=None,
+                           template_once=False, cache=None):
+    """Render a certificate per row of df_final straight into a ZIP.
+
+    template is the .docx as bytes, a file object or a path; out is a path
+    or a writable binary file. on_result(result, total) is called for every
+    generate_certificates() result before it is archived. A fatal result
+    (template syntax error, no PDF converter) raises PipelineError.
+    Stage timings and counters go to report (a RunReport) when given.
+    With template_once (PDF only), a single base certificate is converted
+    and every attendee's PDF is patched from it; certificates that cannot
+    be patched, or all of them if the template does not allow it, are
+    converted as usual.
+    With cache (a cert_cache.CertificateCache), certificates already
+    rendered from the same template and details are copied from the cache
+    and only the rest are rendered; each new certificate is stored as soon
+    as it is ready, so rerunning an interrupted run resumes it.
+
+    Returns a summary dict: 'certificates' (to write), 'files' (written),
+    'errors' and 'warnings' (lists of (name, message)), 'backends' (output
+    count per PDF backend, 'docx' for Word output, 'cache' for cached
+    certificates) and 'template_once' (whether the base PDF could be used;
+    None when not requested).
+    """
+    report = report or RunReport()
+    template_bytes = read_template_bytes(template)
+    jobs = build_jobs(df_final, event_title, event_details)
+    report.count('attendees', len(jobs))
+    return _write_zip(jobs, [template_bytes], out, to_pdf, backend, workers, on_result, report,
+                      template_once, cache)
+
+
+def write_batch_zip(df_final, templates, events, out, to_pdf=False, backend='auto', workers=None,
+                    on_result=None, report=None, template_once=False, cache=None):
+    """Render df_final against several templates and / or events in one run.
+
+    templates is a list of (name, template) pairs (template as for
+    write_certificates_zip) and events a list of (event_title,
+    event_details) pairs. Every attendee x event x template certificate
+    goes into one ZIP, under an "<event title>/<template name>/" folder.
+    All of them are scheduled on one worker pool, and each worker compiles
+    each template once. Options, the on_result callback (whose total is
+    the number of certificates) and the summary are as for
+    write_certificates_zip; template_once is False when the base PDF of
+    any event / template pair could not be used.
+    """
+    report = report or RunReport()
+    template_list = [read_template_bytes(template) for _, template in templates]
+    template_folders = _folder_names([os.path.splitext(os.path.basename(str(name)))[0] for name, _ in templates],
+                                     "Template")
+    event_folders = _folder_names([title for title, _ in events], "Event")
+
+    jobs = []
+    for e, (event_title, event_details) in enumerate(events):
+        event_jobs = build_jobs(df_final, event_title or "", event_details or "")
+        for t, template_folder in enumerate(template_folders):
+            folder = f"{event_folders[e]}/{template_folder}"
+            for job in event_jobs:
+                jobs.append(dict(job, index=len(jobs), template=t, group=(e, t), folder=folder))
+    report.count('attendees', len(df_final))
+    report.count('templates', len(templates))
+    report.count('events', len(events))
+    return _write_zip(jobs, template_list, out, to_pdf, backend, workers, on_result, report,
+                      template_once, cache)
+
+
+def _folder_names(names, fallback):
+    """Archive-safe, distinct folder names; blank names become
+    "<fallback> <n>"."""
+    folders = []
+    for n, name in enumerate(names, 1):
+        folder = re.sub(r'[\\/*?:"<>|]', "", str(name or "")).strip().rstrip('.') or f"{fallback} {n}"
+        unique, k = folder, 2
+        while unique in folders:
+            unique = f"{folder} ({k})"
+            k += 1
+        folders.append(unique)
+    return folders
+
+
+def _write_zip(jobs, templates, out, to_pdf, backend, workers, on_result, report, template_once, cache):
+    summary = {'certificates': len(jobs), 'files': 0, 'errors': [], 'warnings': [], 'backends': {},
+               'template_once': None}
+
+    keys, cached = {}, {}
+    if cache is not None:
+        with report.stage('cache'):
+            digests = [template_digest(template_bytes) for template_bytes in templates]
+            for job in jobs:
+                digest = digests[job.get('template', 0)]
+                keys[job['index']] = key = cache.key(digest, job, to_pdf, backend, template_once)
+                data = cache.get(key)
+                if data is not None:
+                    cached[job['index']] = cached_result(job, data, to_pdf)
+    todo = [job for job in jobs if job['index'] not in cached]
+
+    # One base PDF per template and event (the event text is part of the base)
+    base_pdfs = {}
+    if to_pdf and template_once:
+        groups = {}
+        for job in todo:
+            groups.setdefault(job.get('group'), []).append(job)
+        for group, group_jobs in groups.items():
+            if len(group_jobs) > 1:
+                with report.stage('convert'):
+                    base_pdfs[group] = prepare_base_pdf(templates[group_jobs[0].get('template', 0)], group_jobs, backend)
+        if base_pdfs:
+            summary['template_once'] = all(base is not None for base in base_pdfs.values())
+        base_pdfs = {group: base for group, base in base_pdfs.items() if base is not None}
+
+    results = generate_certificates(
+        todo, templates,
+        to_pdf=to_pdf, workers=workers, backend=backend, base_pdf=base_pdfs,
+    )
+    folders = {job['index']: job.get('folder') for job in jobs}
+    with closing(results), zipfile.ZipFile(out, 'w') as zipf:
+        for res in _in_job_order(jobs, cached, results):
+            report.add_result(res)
+            if on_result:
+                on_result(res, len(jobs))
+            folder = folders[res['index']]
+            name = f"{folder}/{res['name']}" if folder else res['name']
+            if res['error']:
+                summary['errors'].append((name, res['error']))
+                if res['fatal']:
+                    raise PipelineError(res['error'])
+                continue
+            if res['warning']:
+                summary['warnings'].append((name, res['warning']))
+            elif cache is not None and res['index'] not in cached:
+                # A DOCX kept after a failed conversion is not cached: the rerun retries it
+                with report.stage('cache'):
+                    cache.put(keys[res['index']], res['data'])
+            backend_name = res['backend'] or 'docx'
+            summary['backends'][backend_name] = summary['backends'].get(backend_name, 0) + 1
+            arcname = f"{folder}/{res['arcname']}" if folder else res['arcname']
+            with report.stage('package'):
+                add_to_archive(zipf, arcname, res['data'])
+            res['data'] = None
+            summary['files'] += 1
+    return summary
+
+
+def _in_job_order(jobs, cached, results):
+    """Merge cached results with the generated ones (which come for the
+    remaining jobs, in order) back into job order."""
+    for job in jobs:
+        if job['index'] in cached:
+            yield cached.pop(job['index'])
+        else:
+            yield next(results)
+
+
+def _template_name(template, n):
+    name = template if isinstance(template, (str, os.PathLike)) else getattr(template, 'name', None)
+    return os.path.basename(str(name)) if name else f"Template {n}"
+
+
+def _event_texts(events, report, log):
+    """(title, details) of each event dict, fetching the pages of the
+    events that do not give both."""
+    events = [dict(event) for event in events]
+    pending = [e for e in events if e.get('url') and (e.get('title') is None or e.get('details') is None)]
+    if pending:
+        with report.stage('fetch'):
+            infos = fetch_events([e['url'] for e in pending])
+        for event, info in zip(pending, infos):
+            if info['error']:
+                raise PipelineError(f"cannot fetch event page {info['url']}: {info['error']}")
+            if info['title'] is None or info['details'] is None:
+                log(f"event page is missing the title or date: {info['url']}")
+            for key in ('title', 'details'):
+                if event.get(key) is None:
+                    event[key] = info[key]
+    return [(e.get('title') or "", e.get('details') or "") for e in events]
+
+
+def run_event(registration, template, out, zoom=None, event_url=None,
+              event_title=None, event_details=None, to_pdf=False, backend='auto',
+              workers=None, match_names=False, name_threshold=NAME_MATCH_THRESHOLD,
+              log=None, report=None, template_once=False, cache=None, events=None):
+    """Run every step for one event and write the certificates ZIP to out.
+
+    registration, zoom and template are paths or binary file objects;
+    without zoom every registrant gets a certificate. Attendees are matched
+    by email; match_names adds the name fallback, whose matches go straight
+    into the ZIP with nobody to confirm them, so it is off by default.
+    event_title /
+    event_details, when given, take precedence over the page at event_url.
+    log(message) receives progress and warning lines; report (a RunReport)
+    collects the timings of every stage; cache is passed on to
+    write_certificates_zip().
+
+    Batch mode: with a list of templates, or with events (a list of dicts
+    with 'url', 'title' and / or 'details', used instead of event_url /
+    event_title / event_details), the attendees are parsed and matched
+    once and write_batch_zip() renders every event x template
+    combination into one ZIP. Event pages are fetched concurrently.
+
+    Returns the write_certificates_zip() summary plus 'attendees',
+    'unmatched' and 'matched_by_name' counts.
+    """
+    log = log or (lambda message: None)
+    report = report or RunReport()
+    batch = isinstance(template, (list, tuple)) or events is not None
+    # Read up front: a missing template should fail before any matching work
+    templates = [
+        (_template_name(t, n), read_template_bytes(t))
+        for n, t in enumerate(template if isinstance(template, (list, tuple)) else [template], 1)
+    ]
+    if events is None:
+        events = [{'url': event_url, 'title': event_title, 'details': event_details}]
+    events = _event_texts(events, report, log)
+
+    with report.stage('parse'):
+        df_reg, missing_membership = load_registration(registration)
+    if missing_membership:
+        log("no Membership No column found; membership numbers will be blank")
+    missing = missing_required_columns(df_reg)
+    if missing:
+        raise PipelineError(f"registration file is missing columns {missing} (found {df_reg.columns.tolist()})")
+
+    unmatched = matched_by_name = 0
+    if zoom is None:
+        df_final = registration_only(df_reg)
+    else:
+        with report.stage('parse'):
+            zoom_info = load_zoom(zoom)
+        if zoom_info['error']:
+            raise PipelineError(f"cannot parse Zoom report: {zoom_info['error']}")
+        if 'df' not in zoom_info:
+            raise PipelineError(f"Zoom report has no User Name / Email column (found {zoom_info['columns']})")
+        with report.stage('match'):
+            df_final, df_unmatched = match_registration(df_reg, zoom_info, match_names, name_threshold)
+        unmatched = len(df_unmatched)
+        matched_by_name = int((df_final['Match Method'] == "Matched (Name)").sum())
+        if unmatched:
+            log(f"{unmatched} registrants not found in the Zoom report")
+        if matched_by_name:
+            log(f"{matched_by_name} registrants matched by name; please review")
+
+    if df_final.empty:
+        raise PipelineError("no attendees to certify")
+
+    options = dict(to_pdf=to_pdf, backend=backend, workers=workers, report=report,
+                   template_once=template_once, cache=cache)
+    if batch:
+        summary = write_batch_zip(df_final, templates, events, out, **options)
+    else:
+        event_title, event_details = events[0]
+        summary = write_certificates_zip(df_final, templates[0][1], out, event_title, event_details, **options)
+    if summary['template_once'] is False:
+        log("template-once mode is not possible with this template; converted every certificate")
+    for name, message in summary['errors']:
+        log(f"{name}: {message}")
+    for name, message in summary['warnings']:
+        log(f"{name}: PDF conversion failed, kept DOCX ({message})")
+    summary.update(attendees=len(df_final), unmatched=unmatched, matched_by_name=matched_by_name)
+    return summary
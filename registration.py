@@ -0,0 +1,119 @@
+"""Registration list loading and column mapping."""
+import pandas as pd
+
+REQUIRED_COLUMNS = ['First Name', 'Last Name', 'Email']
+# Rows per chunk when reading a registration CSV
+CSV_CHUNK_ROWS = 50000
+
+
+def column_mapping(columns):
+    """Map registration headers (English or Chinese) to the standard names.
+    Returns (col_map, has_full_name)."""
+    # --- 強化的欄位對應邏輯 ---
+    col_map = {}
+    has_full_name = False
+
+    for c in columns:
+        c_lower = str(c).lower().strip()
+        if 'full name' in c_lower:
+            col_map[c] = 'Full Name'
+            has_full_name = True
+        elif 'first name' in c_lower or '名字' in c_lower:
+            col_map[c] = 'First Name'
+        elif 'last name' in c_lower or '姓氏' in c_lower:
+            col_map[c] = 'Last Name'
+        elif 'contact email' in c_lower:
+            col_map[c] = 'Email'
+        elif 'email' in c_lower or '電郵' in c_lower:
+            col_map[c] = 'Email'
+        elif 'hkie membership' in c_lower or 'membership no' in c_lower or '會員編號' in c_lower:
+            col_map[c] = 'Membership No'
+        elif 'salutation' in c_lower or '稱呼' in c_lower:
+            col_map[c] = 'Salutation'
+
+    return col_map, has_full_name
+
+
+def _is_csv(file_obj):
+    return str(getattr(file_obj, 'name', file_obj)).endswith('.csv')
+
+
+def _rewind(file_obj):
+    if hasattr(file_obj, 'seek'):
+        file_obj.seek(0)
+
+
+def read_registration(file_obj):
+    """Read a registration CSV / Excel file (upload, file object or path).
+
+    Only the header row is read first; the columns column_mapping() does
+    not recognise are then skipped, the names and email are read as
+    strings (Membership No too, so Excel numbers do not gain a '.0') and
+    Salutation as a category. A CSV is read in chunks of CSV_CHUNK_ROWS.
+    When the header lacks the name or email columns every column is read,
+    so that the caller can report what was found.
+    """
+    is_csv = _is_csv(file_obj)
+    header = (pd.read_csv if is_csv else pd.read_excel)(file_obj, nrows=0).columns
+    _rewind(file_obj)
+
+    col_map, _ = column_mapping(header)
+    found = set(col_map.values())
+    if 'Email' not in found or not ('Full Name' in found or {'First Name', 'Last Name'} <= found):
+        return pd.read_csv(file_obj) if is_csv else pd.read_excel(file_obj)
+
+    usecols = [pos for pos, c in enumerate(header) if c in col_map]
+    dtype = {c: str for c in col_map}
+    if is_csv:
+        chunks = pd.read_csv(file_obj, usecols=usecols, dtype=dtype, chunksize=CSV_CHUNK_ROWS)
+        df_reg = pd.concat(chunks, ignore_index=True)
+    else:
+        df_reg = pd.read_excel(file_obj, usecols=usecols, dtype=dtype)
+    # A handful of distinct values (Ir, Dr, Mr, ...)
+    for c, target in col_map.items():
+        if target == 'Salutation':
+            df_reg[c] = df_reg[c].astype('category')
+    return df_reg
+
+
+def map_registration_columns(df_reg):
+    """Rename registration columns (English or Chinese headers) to the
+    standard names and fill in the optional ones.
+    Returns (df_reg, missing_membership)."""
+    col_map, has_full_name = column_mapping(df_reg.columns)
+    df_reg.rename(columns=col_map, inplace=True)
+
+    # 如果有 Full Name 但沒有 First Name / Last Name，需要拆分
+    if has_full_name and 'Full Name' in df_reg.columns:
+        if 'First Name' not in df_reg.columns or 'Last Name' not in df_reg.columns:
+            # 拆分 Full Name 為 First Name 和 Last Name
+            name_split = df_reg['Full Name'].astype(str).str.strip().str.split(n=1, expand=True)
+            if name_split.shape[1] == 2:
+                df_reg['First Name'] = name_split[0]
+                df_reg['Last Name'] = name_split[1]
+            else:
+                # 如果只有一個詞，全部當作 First Name
+                df_reg['First Name'] = name_split[0]
+                df_reg['Last Name'] = ""
+
+    # 檢查是否成功抓到 Membership No
+    missing_membership = 'Membership No' not in df_reg.columns
+    if missing_membership:
+        # 嘗試建立一個空的欄位以防報錯
+        df_reg['Membership No'] = ""
+
+    # 如果沒有 Salutation 欄位，建立一個空的
+    if 'Salutation' not in df_reg.columns:
+        df_reg['Salutation'] = ""
+
+    return df_reg, missing_membership
+
+
+def missing_required_columns(df_reg):
+    """Return the REQUIRED_COLUMNS not present after mapping."""
+    return [col for col in REQUIRED_COLUMNS if col not in df_reg.columns]
+
+
+def load_registration(file_obj):
+    """read_registration + map_registration_columns."""
+    return map_registration_columns(read_registration(file_obj))
@@ -0,0 +1,133 @@
+"""Timing and resource report for one generation run.
+
+A RunReport collects wall-clock time per pipeline stage (fetch, parse,
+match, cache, render, convert, encrypt, patch, package), counters, per-attendee latency
+and peak memory, and turns them into a JSON-serialisable dict:
+
+    report = RunReport()
+    with report.stage('parse'):
+        ...
+    report.count('certificates')
+    report.as_dict()
+
+Render / convert / encrypt run in the worker processes; their timings come
+back in each generate_certificates() result and are added with
+add_result(). profiled() wraps a call in cProfile for a one-off deep dive.
+"""
+import cProfile
+import io
+import pstats
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Stages in pipeline order, for a stable report layout
+STAGES = ('fetch', 'parse', 'match', 'cache', 'render', 'convert', 'encrypt', 'patch', 'package')
+
+
+def peak_rss_mb(children=False):
+    """Peak resident memory of this process (or of its finished child
+    processes) in MB; None where the platform does not report it."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return round(usage.ru_maxrss * scale / 2 ** 20, 1)
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Nearest-rank percentiles of values (seconds) as milliseconds."""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    out = {}
+    for p in points:
+        rank = max(1, -(-p * len(ordered) // 100))
+        out[f'p{p}'] = round(ordered[rank - 1] * 1000, 2)
+    out['max'] = round(ordered[-1] * 1000, 2)
+    out['mean'] = round(sum(ordered) / len(ordered) * 1000, 2)
+    return out
+
+
+class RunReport:
+    """Stage timers, counters and per-attendee latency for one run."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}        # name -> {'seconds': float, 'count': int}
+        self.counters = {}
+        self.latencies = []     # seconds per attendee (render + convert + encrypt, or patch)
+        self.profile = None     # pstats text from profiled()
+        self.profiler = None
+
+    @contextmanager
+    def stage(self, name, count=1):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started, count)
+
+    def add(self, name, seconds, count=1):
+        entry = self.stages.setdefault(name, {'seconds': 0.0, 'count': 0})
+        entry['seconds'] += seconds
+        entry['count'] += count
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_result(self, res):
+        """Fold the worker-side timings of one generate_certificates() result in."""
+        timings = res.get('timings') or {}
+        for name, seconds in timings.items():
+            self.add(name, seconds)
+        if timings:
+            self.latencies.append(sum(timings.values()))
+        if res['error']:
+            self.count('errors')
+        else:
+            self.count(res['backend'] or 'docx')
+            if res['warning']:
+                self.count('warnings')
+
+    def as_dict(self):
+        def order(name):
+            return (STAGES.index(name) if name in STAGES else len(STAGES), name)
+
+        stages = {}
+        for name in sorted(self.stages, key=order):
+            entry = self.stages[name]
+            stages[name] = {
+                'seconds': round(entry['seconds'], 4),
+                'count': entry['count'],
+                'mean_ms': round(entry['seconds'] * 1000 / entry['count'], 2) if entry['count'] else None,
+            }
+        report = {
+            'wall_seconds': round(time.perf_counter() - self.started, 3),
+            'stages': stages,
+            'counters': dict(self.counters),
+            'latency_ms': percentiles(self.latencies),
+            'peak_memory_mb': {'main': peak_rss_mb(), 'workers': peak_rss_mb(children=True)},
+        }
+        if self.profile:
+            report['profile'] = self.profile
+        return report
+
+    def profiled(self, func, *args, limit=30, **kwargs):
+        """Run func under cProfile and keep the top `limit` functions by
+        cumulative time in the report. Only the calling process is
+        profiled; run the certificates in-process (workers=1) to see them."""
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+            self.profile = out.getvalue()
+            self.profiler = profiler
@@ -0,0 +1,118 @@
+"""event_info against a local http.server standing in for the HKIE site."""
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from event_info import DETAILS_ID, TITLE_ID, fetch_event_info, fetch_events
+
+PAGE = (f'<html><body><span id="{TITLE_ID}">Cloud <b>Security</b> Seminar</span>'
+        f'<table id="{DETAILS_ID}"><tr><td>Date<td>1 May 2024;2:00pm</table>'
+        '<p>Footer<p>More footer</body></html>')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Serves server.pages: path -> {'body', 'etag', 'filler', 'release'}."""
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+        page = self.server.pages.get(self.path)
+        if page is None:
+            self.send_error(404)
+            return
+        if page.get('etag') and self.headers.get('If-None-Match') == page['etag']:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        if page.get('etag'):
+            self.send_header('ETag', page['etag'])
+        self.end_headers()
+        self.wfile.write(page['body'].encode('utf-8'))
+        if page.get('release'):
+            # The rest of the page only comes once the test allows it
+            self.wfile.write(b' ' * page['filler'])
+            self.wfile.flush()
+            page['release'].wait(10)
+            self.wfile.write(b'<p>late</p></body></html>')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    httpd.pages = {}
+    httpd.requests = []
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    for page in httpd.pages.values():
+        if page.get('release'):
+            page['release'].set()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_fetch_stores_etag(server, tmp_path):
+    server.pages['/event'] = {'body': PAGE, 'etag': '"v1"'}
+
+    info = fetch_event_info(server.url + '/event', cache_dir=str(tmp_path))
+
+    assert info == {'title': 'CloudSecuritySeminar', 'details': 'Date1 May 2024 2:00pm'}
+    [entry] = os.listdir(tmp_path)
+    with open(tmp_path / entry, encoding='utf-8') as f:
+        cached = json.load(f)
+    assert cached['etag'] == '"v1"'
+    assert cached['info'] == info
+
+
+def test_revalidation_uses_cached_info(server, tmp_path):
+    server.pages['/event'] = {'body': PAGE, 'etag': '"v1"'}
+    first = fetch_event_info(server.url + '/event', cache_dir=str(tmp_path))
+    # A 304 must be answered from the cache, not from the (changed) page
+    server.pages['/event']['body'] = PAGE.replace('Cloud', 'Changed')
+
+    second = fetch_event_info(server.url + '/event', cache_dir=str(tmp_path))
+
+    assert second == first
+    assert server.requests == [('/event', None), ('/event', '"v1"')]
+
+
+def test_missing_element_is_none(server, tmp_path):
+    server.pages['/event'] = {'body': f'<html><span id="{TITLE_ID}">Only a title</span></html>'}
+
+    info = fetch_event_info(server.url + '/event', cache_dir=str(tmp_path))
+
+    assert info == {'title': 'Only a title', 'details': None}
+    # No validators: nothing to revalidate, so nothing is cached
+    assert os.listdir(tmp_path) == []
+
+
+def test_stops_reading_once_both_elements_are_found(server, tmp_path):
+    release = threading.Event()
+    # The filler fills the first read chunk; the server then holds the connection open
+    server.pages['/event'] = {'body': PAGE, 'filler': 64 * 1024, 'release': release}
+
+    info = fetch_event_info(server.url + '/event', cache_dir=str(tmp_path), timeout=(5, 2))
+
+    assert info['details'] == 'Date1 May 2024 2:00pm'
+    assert not release.is_set()
+
+
+def test_fetch_events_keeps_order_and_reports_failures(server, tmp_path):
+    for n in (1, 3):
+        server.pages[f'/event{n}'] = {'body': PAGE.replace('Cloud', f'Event{n}')}
+    urls = [server.url + f'/event{n}' for n in (1, 2, 3)]
+
+    results = fetch_events(urls, workers=3, cache_dir=str(tmp_path))
+
+    assert [r['url'] for r in results] == urls
+    assert [r['title'] for r in results] == ['Event1SecuritySeminar', None, 'Event3SecuritySeminar']
+    assert results[0]['error'] is None and results[2]['error'] is None
+    assert '404' in results[1]['error']